@@ -0,0 +1,372 @@
+"""
+DataCheck 的性能基准测试
+
+使用本地启动的 mongod（源和目标各一个）或进程内的 mongomock-motor 作为 mongo，
+生成可配置数据量、文档结构、_id 类型和不一致比例的数据，
+在不同的 check_batch_size/task_concurrent 下通过 core.check_all 运行检查（和 mongocheckd 相同的路径），
+统计 docs/sec、bytes/doc、峰值内存（RSS）和请求次数，结果写入 json 文件。
+请求次数通过 pymongo 的 CommandListener 统计发送到 mongod 的命令（包括游标的 getMore），
+mongomock 没有命令事件，mock 时不统计。
+
+每个配置在单独的子进程中运行，峰值内存互不影响。
+计时的检查不开启指标统计（指标统计需要编码每个文档计算字节数），bytes/doc 在检查后单独读取一遍源数据统计。
+mock 时数据保存在子进程中，mongomock 占用的内存单独记录为 mock_storage_kb。
+
+eg:
+  # 使用 PATH 中的 mongod
+  python -m benchmarks.bench_datacheck --docs 20000 --batch-sizes 50,200,1000 --task-concurrents 1,4
+  # 没有 mongod 时使用 mongomock-motor（pip3 install mongomock-motor）
+  python -m benchmarks.bench_datacheck --backend mock --docs 5000
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import threading
+import multiprocessing
+from queue import Empty
+from pathlib import Path
+from typing import Iterator
+import bson
+from bson.objectid import ObjectId
+from pymongo import monitoring
+from pymongo.uri_parser import parse_uri
+
+
+ID_TYPES = ("objectid", "int", "str")
+SHAPES = ("flat", "nested")
+DB_NAME = "bench"
+
+
+def gen_id(rnd: random.Random, id_type: str, i: int):
+    if id_type == "objectid":
+        # 由随机种子生成，每次运行的 _id 相同
+        return ObjectId(rnd.randbytes(12))
+    elif id_type == "int":
+        return i
+    elif id_type == "str":
+        return f"id-{i:012d}"
+    raise ValueError(f"id_type 错误: {id_type}")
+
+
+def gen_doc(rnd: random.Random, shape: str, fields: int) -> dict:
+    """生成一个文档，flat 为标量字段，nested 包含子文档和数组"""
+    doc = {}
+    for i in range(fields):
+        kind = i % 4
+        if kind == 0:
+            doc[f"f{i}"] = rnd.randint(0, 1 << 40)
+        elif kind == 1:
+            doc[f"f{i}"] = rnd.random()
+        elif kind == 2:
+            doc[f"f{i}"] = "".join(rnd.choices("abcdefghijklmnopqrstuvwxyz", k=16))
+        else:
+            doc[f"f{i}"] = rnd.random() > 0.5
+    if shape == "nested":
+        doc["sub"] = {"a": dict(doc), "tags": [f"t{rnd.randint(0, 99)}" for _ in range(8)]}
+        doc["items"] = [{"n": j, "v": rnd.random()} for j in range(5)]
+    return doc
+
+
+def gen_batches(args, size: int = 10000) -> Iterator[tuple[str, list[dict], list[dict], int]]:
+    """按批次生成每个集合的源数据、目标数据和这一批期望的不一致数量，随机种子相同时生成的数据相同
+
+    不一致的数据中，一半是目标缺失，一半是字段值不同。
+    """
+    rnd = random.Random(args.seed)
+    id_types = args.id_types.split(",")
+    for c in range(args.collections):
+        src_docs, dst_docs, expect_mismatches = [], [], 0
+        for i in range(args.docs):
+            doc = {"_id": gen_id(rnd, id_types[i % len(id_types)], i), **gen_doc(rnd, args.shape, args.fields)}
+            src_docs.append(doc)
+            if rnd.random() < args.mismatch_rate:
+                expect_mismatches += 1
+                if rnd.random() >= 0.5:
+                    dst_docs.append({**doc, "f0": -1})
+            else:
+                dst_docs.append(doc)
+            if len(src_docs) >= size:
+                yield f"coll{c}", src_docs, dst_docs, expect_mismatches
+                src_docs, dst_docs, expect_mismatches = [], [], 0
+        if src_docs:
+            yield f"coll{c}", src_docs, dst_docs, expect_mismatches
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mongod(mongod: str, dbpath: Path) -> tuple[subprocess.Popen, str]:
+    """启动一个本地 mongod，返回进程和 uri"""
+    from pymongo import MongoClient
+
+    dbpath.mkdir(parents=True, exist_ok=True)
+    port = get_free_port()
+    proc = subprocess.Popen([mongod, "--dbpath", f"{dbpath}", "--port", f"{port}",
+                             "--bind_ip", "127.0.0.1", "--quiet"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    uri = f"mongodb://127.0.0.1:{port}/{DB_NAME}"
+    client = MongoClient(uri, serverSelectionTimeoutMS=30000)
+    try:
+        client.admin.command("ping")
+    except Exception:
+        proc.kill()
+        raise
+    finally:
+        client.close()
+    return proc, uri
+
+
+def load_dataset_mongod(src_uri: str, dst_uri: str, args) -> int:
+    """写入源和目标 mongod，返回期望的不一致数量"""
+    from pymongo import MongoClient
+
+    src_client, dst_client = MongoClient(src_uri), MongoClient(dst_uri)
+    for c in range(args.collections):
+        src_client[DB_NAME].drop_collection(f"coll{c}")
+        dst_client[DB_NAME].drop_collection(f"coll{c}")
+    expect_mismatches = 0
+    for coll, src_docs, dst_docs, mismatches in gen_batches(args):
+        src_client[DB_NAME][coll].insert_many(src_docs, ordered=False)
+        if dst_docs:
+            dst_client[DB_NAME][coll].insert_many(dst_docs, ordered=False)
+        expect_mismatches += mismatches
+    src_client.close()
+    dst_client.close()
+    return expect_mismatches
+
+
+async def use_mock_clients(args):
+    """把 mongo_src/mongo_dst 替换为 mongomock-motor 的客户端并写入数据"""
+    from munch import DefaultMunch
+    from mongomock_motor import AsyncMongoMockClient
+    from framework.mongoclient import mongo_src, mongo_dst
+
+    for mongo in (mongo_src, mongo_dst):
+        # AsMongo 的客户端是私有属性，只在基准测试中替换
+        mongo._AsMongo__client = AsyncMongoMockClient(document_class=DefaultMunch)
+    for coll, src_docs, dst_docs, _ in gen_batches(args):
+        await mongo_src.client[DB_NAME][coll].insert_many(src_docs)
+        if dst_docs:
+            await mongo_dst.client[DB_NAME][coll].insert_many(dst_docs)
+
+
+def get_rss_kb() -> int | None:
+    """当前进程的 RSS（KB），只支持 linux"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_peak_rss_kb() -> int | None:
+    """当前进程的峰值 RSS（KB），windows 不支持时返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 的单位是字节
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+async def measure_src_bytes(colls: list[str]) -> int:
+    """单独读取一遍源数据统计 bson 字节数，不计入检查的耗时"""
+    from framework.mongoclient import mongo_src
+
+    total = 0
+    for coll in colls:
+        async for doc in mongo_src.client[DB_NAME][coll].find({}):
+            total += len(bson.encode(doc))
+    return total
+
+
+class CommandCounter(monitoring.CommandListener):
+    """统计发送到服务端的命令数，按连接的地址区分源和目标
+
+    motor 在线程池中执行 pymongo 的操作，计数需要加锁。
+    """
+    def __init__(self, sides: dict[tuple[str, int], str]):
+        self.sides = sides
+        self.counts: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        side = self.sides.get(event.connection_id, f"{event.connection_id}")
+        key = f"{side}.{event.command_name}"
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        pass
+
+
+def register_command_counter(src_uri: str, dst_uri: str) -> CommandCounter:
+    """注册全局的命令监听，需要在创建 mongo 客户端之前调用"""
+    sides = {node: side for uri, side in ((src_uri, "src"), (dst_uri, "dst"))
+             for node in parse_uri(uri)["nodelist"]}
+    counter = CommandCounter(sides)
+    monitoring.register(counter)
+    return counter
+
+
+async def run_bench(args, command_counter: CommandCounter) -> dict:
+    from framework import core
+    from framework import metrics
+
+    colls = [f"coll{c}" for c in range(args.collections)]
+    result = {}
+    if args.backend == "mock":
+        rss_start = get_rss_kb()
+        await use_mock_clients(args)
+        rss_loaded = get_rss_kb()
+        result["mock_storage_kb"] = rss_loaded - rss_start if rss_start is not None else None
+
+    rss_before, peak_before = get_rss_kb(), get_peak_rss_kb()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    await core.check_all()
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    peak_rss = get_peak_rss_kb()
+
+    docs = sum(metrics.docs_checked.values.values())
+    with command_counter.lock:
+        round_trips = dict(sorted(command_counter.counts.items()))
+    src_bytes = await measure_src_bytes(colls)
+    result.update(
+        docs=docs, seconds=elapsed, cpu_seconds=cpu,
+        docs_per_second=docs / elapsed if elapsed else 0,
+        bytes_per_doc=src_bytes / docs if docs else 0,
+        rss_before_kb=rss_before, peak_rss_kb=peak_rss,
+        # 峰值在检查前（写入 mock 数据时）时为 0
+        check_peak_rss_kb=peak_rss - max(rss_before or 0, peak_before or 0) if peak_rss is not None else None,
+        # mongomock 不发送命令，没有请求次数
+        round_trips=sum(round_trips.values()) if args.backend == "mongod" else None,
+        round_trips_detail=round_trips,
+        mismatches=sum(metrics.mismatches.values.values()),
+    )
+    return result
+
+
+def run_one(args, batch_size: int, task_concurrent: int, src_uri: str, dst_uri: str,
+            expect_mismatches: int, queue):
+    """在子进程中通过 core.check_all 运行一次检查并返回统计结果"""
+    os.environ.update(
+        MONGO_SRC_URI=src_uri, MONGO_DST_URI=dst_uri,
+        CHECK_COLLECTIONS=",".join(f"{DB_NAME}.coll{c}" for c in range(args.collections)),
+        CHECK_BATCH_SIZE=f"{batch_size}", TASK_CONCURRENT=f"{task_concurrent}",
+        SHARD_AWARE="false", REPAIR="false",
+    )
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    from framework.checkcoll import DataCheck
+
+    command_counter = register_command_counter(src_uri, dst_uri)
+    DataCheck.result_path = Path(tempfile.mkdtemp(prefix="bench-result-"))
+    try:
+        result = asyncio.run(run_bench(args, command_counter))
+    finally:
+        shutil.rmtree(DataCheck.result_path, ignore_errors=True)
+    queue.put(dict(check_batch_size=batch_size, task_concurrent=task_concurrent,
+                   expect_mismatches=expect_mismatches, **result))
+
+
+def wait_result(proc: multiprocessing.Process, queue) -> dict:
+    """等待子进程返回结果，子进程异常退出时报错"""
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not proc.is_alive():
+                raise RuntimeError(f"基准测试子进程异常退出: {proc.exitcode}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DataCheck 性能基准测试")
+    parser.add_argument("--backend", choices=("mongod", "mock"), default="mongod",
+                        help="mongod: 启动本地 mongod；mock: 使用进程内的 mongomock-motor")
+    parser.add_argument("--mongod", default=shutil.which("mongod") or "mongod", help="mongod 可执行文件")
+    parser.add_argument("--docs", type=int, default=10000, help="每个集合的文档数")
+    parser.add_argument("--collections", type=int, default=1, help="集合数量")
+    parser.add_argument("--shape", choices=SHAPES, default="flat", help="文档结构")
+    parser.add_argument("--fields", type=int, default=10, help="每个文档的字段数")
+    parser.add_argument("--id-types", default="objectid", help=f"_id 类型，多个时交替使用: {','.join(ID_TYPES)}")
+    parser.add_argument("--mismatch-rate", type=float, default=0.01, help="目标数据不一致的比例")
+    parser.add_argument("--batch-sizes", default="50,200", help="check_batch_size，多个用逗号分隔")
+    parser.add_argument("--task-concurrents", default="2", help="task_concurrent，多个用逗号分隔")
+    parser.add_argument("--seed", type=int, default=0, help="生成数据的随机种子")
+    parser.add_argument("--output", default="bench_result.json", help="结果文件")
+    args = parser.parse_args()
+    if any(t not in ID_TYPES for t in args.id_types.split(",")):
+        parser.error(f"--id-types 只支持 {','.join(ID_TYPES)}")
+    return args
+
+
+def main():
+    args = parse_args()
+    src_uri = dst_uri = f"mongodb://127.0.0.1:27017/{DB_NAME}"
+    procs, tmp_dir = [], None
+    if args.backend == "mongod":
+        tmp_dir = Path(tempfile.mkdtemp(prefix="bench-mongod-"))
+        p1, src_uri = start_mongod(args.mongod, tmp_dir / "src")
+        procs.append(p1)
+        p2, dst_uri = start_mongod(args.mongod, tmp_dir / "dst")
+        procs.append(p2)
+    try:
+        if args.backend == "mongod":
+            expect_mismatches = load_dataset_mongod(src_uri, dst_uri, args)
+        else:
+            # mock 的数据在子进程中写入，这里只计算期望的不一致数量
+            expect_mismatches = sum(batch[3] for batch in gen_batches(args))
+
+        ctx = multiprocessing.get_context("spawn")
+        runs = []
+        for batch_size in [int(x) for x in args.batch_sizes.split(",")]:
+            for task_concurrent in [int(x) for x in args.task_concurrents.split(",")]:
+                queue = ctx.Queue()
+                proc = ctx.Process(target=run_one,
+                                   args=(args, batch_size, task_concurrent, src_uri, dst_uri,
+                                         expect_mismatches, queue))
+                proc.start()
+                result = wait_result(proc, queue)
+                proc.join()
+                runs.append(result)
+                print(f"check_batch_size={batch_size} task_concurrent={task_concurrent}: "
+                      f"{result['docs_per_second']:.0f} docs/s, {result['bytes_per_doc']:.0f} bytes/doc, "
+                      f"peak rss {result['peak_rss_kb']} KB, {result['round_trips'] if result['round_trips'] is not None else '-'} round trips, "
+                      f"{result['mismatches']}/{result['expect_mismatches']} mismatches")
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    output = dict(
+        time=time.time(),
+        env=dict(python=platform.python_version(), platform=platform.platform(), backend=args.backend),
+        params={k: v for k, v in vars(args).items() if k not in ("output", "mongod")},
+        runs=runs,
+    )
+    Path(args.output).write_text(json.dumps(output, ensure_ascii=False, indent=2))
+    print(f"结果写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,3 +11,9 @@ from .base import TypeMongoId
 
 from .utils.collection_meta import MongoCollMetaSeqs
 from .utils.usefull import MongoColl
+from .utils.paginate import KeysetPaginator
+from .utils.paginate import get_key_value
+from .utils.paginate import range_filter
+from .utils.paginate import bson_sort_key
+from .utils.paginate import get_bson_type
+from .utils.paginate import bson_hash_key
@@ -0,0 +1,256 @@
+"""
+keyset 分页的异步迭代器
+
+使用 {key: {"$gt": 上一页最后的值}} 代替 skip/limit 分页，每一页的查询代价是固定的。
+处理当前页时后台预取下一页，并且可以按目标耗时自动调整每页的数量。
+
+key 不是 _id 时按 (key, _id) 排序分页，需要有 {key: 1, _id: 1} 索引。
+
+mongodb 的 $gt/$lt 等只比较同一类型的值（type bracketing），
+分页的值有多种类型时（如 _id 同时有 int 和 ObjectId），使用 range_filter 同时匹配排序在前面或后面的类型。
+"""
+import time
+import asyncio
+from decimal import Decimal
+from datetime import datetime
+from typing import AsyncIterator, Callable
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import PyMongoError
+
+from ..base import AsMongoError, TypeMongoId
+
+
+# BSON 类型的排序顺序（$type 的别名），只包括常用作 _id 和排序字段的类型
+_bson_type_order = ("null", "number", "string", "object", "array", "binData",
+                    "objectId", "bool", "date")
+
+
+def get_bson_type(value) -> str | None:
+    """获取值的 BSON 类型别名，未知类型返回 None"""
+    if value is None:
+        return "null"
+    # bool 是 int 的子类，需要先判断
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float, Decimal128)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, dict):
+        return "object"
+    if isinstance(value, (list, tuple)):
+        return "array"
+    if isinstance(value, (bytes, Binary)):
+        return "binData"
+    if isinstance(value, ObjectId):
+        return "objectId"
+    if isinstance(value, datetime):
+        return "date"
+    return None
+
+
+def range_filter(key: str, op: str, value, mixed_types: bool = True) -> dict:
+    """跨类型的范围查询条件，op 为 $gt/$gte/$lt/$lte
+
+    eg: range_filter("_id", "$gt", 5) 同时匹配 _id 为字符串、ObjectId 等排序在数字后面的类型
+    mixed_types 为 False 时（已知 key 只有一种类型）只返回 {key: {op: value}}，
+      多出的 $type 条件会让查询不能只使用索引的范围边界
+    """
+    type_name = get_bson_type(value)
+    if type_name is None or not mixed_types:
+        return {key: {op: value}}
+    i = _bson_type_order.index(type_name)
+    other_types = _bson_type_order[i + 1:] if op in ("$gt", "$gte") else _bson_type_order[:i]
+    if not other_types:
+        return {key: {op: value}}
+    # null 用 {key: None} 匹配，同时匹配字段不存在的文档（排序时和 null 相同）
+    return {"$or": [{key: {op: value}},
+                    *[{key: None} if t == "null" else {key: {"$type": t}} for t in other_types]]}
+
+
+def bson_sort_key(value) -> tuple:
+    """按 BSON 的排序规则比较不同类型的值，eg: sorted(ids, key=bson_sort_key)"""
+    if isinstance(value, MinKey):
+        return -1, 0
+    if isinstance(value, MaxKey):
+        return len(_bson_type_order), 0
+    type_name = get_bson_type(value)
+    if type_name is None:
+        raise ValueError(f"不支持比较的类型: {type(value)}")
+    if type_name == "number":
+        # int/float/Decimal128 按数值比较，NaN 排在所有数字前面
+        number = value.to_decimal() if isinstance(value, Decimal128) else value
+        if number.is_nan() if isinstance(number, Decimal) else number != number:
+            return _bson_type_order.index(type_name), (0, 0)
+        return _bson_type_order.index(type_name), (1, number)
+    return _bson_type_order.index(type_name), value
+
+
+def bson_hash_key(value) -> tuple:
+    """BSON 值作为 dict 的 key
+
+    python 中 1 == 1.0 == True，但是 BSON 中 true 和 1 是不同的值（1 和 1.0 是相同的 _id），
+    按 (BSON 类型, 值) 区分，不能 hash 的值（子文档、数组）使用 extended json 字符串。
+    """
+    type_name = get_bson_type(value)
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    try:
+        hash(value)
+    except TypeError:
+        value = json_util.dumps(value)
+    return type_name, value
+
+
+def get_key_value(data: dict, key: str):
+    """获取文档中 key 的值，支持 a.b 格式的嵌套 key"""
+    for k in key.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(k)
+    return data
+
+
+class KeysetPaginator:
+    """keyset 分页
+
+    eg:
+      async for page in KeysetPaginator(coll, {"status": 1}, {"_id": 1}).pages():
+          ...
+      async for doc in KeysetPaginator(coll, key="created_at"):
+          ...
+    """
+    def __init__(self, collection: AsyncIOMotorCollection,
+                 filter_doc: dict = None, projection: dict = None, *,
+                 key: str = "_id",
+                 offset: TypeMongoId | tuple[object, TypeMongoId] = None,
+                 hint: str | dict | list = None,
+                 page_size: int = 100,
+                 min_page_size: int = 1,
+                 max_page_size: int = 10000,
+                 target_latency: float = None,
+                 max_time_ms: int = None,
+                 prefetch: bool = True,
+                 mixed_types: bool = True,
+                 on_fetch: Callable[[list[dict], float], None] = None,
+                 ):
+        """
+        collection      motor 集合对象
+        filter_doc      查询条件
+        projection      返回的字段，需要包含 key（和 _id）
+        key             分页的字段，默认 _id
+        offset          从该位置之后开始获取，key 为 _id 时是 _id 的值，否则是 (key值, _id)
+        hint            查询使用的索引
+        page_size       每页的数量
+        min_page_size   自动调整时每页的最小数量
+        max_page_size   自动调整时每页的最大数量
+        target_latency  每页查询的目标耗时（秒），设置后按耗时自动调整 page_size
+        max_time_ms     每页查询的服务端超时时间，默认不限制（使用客户端的 timeoutMS）
+        prefetch        处理当前页时是否后台预取下一页
+        mixed_types     key（和 _id）是否有多种 BSON 类型，为 False 时分页条件不添加跨类型的 $type 条件
+        on_fetch        每页查询完成后的回调 on_fetch(page, 耗时秒)，可用于统计
+        """
+        self.collection = collection
+        self.filter_doc = filter_doc or {}
+        self.projection = projection
+        self.key = key
+        self.offset = offset
+        self.hint = hint
+        self.page_size = page_size
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.target_latency = target_latency
+        self.max_time_ms = max_time_ms
+        self.prefetch = prefetch
+        self.mixed_types = mixed_types
+        self.on_fetch = on_fetch
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.collection.full_name} {self.key} {self.offset}>"
+
+    def get_sort(self) -> list[tuple[str, int]]:
+        if self.key == "_id":
+            return [("_id", 1)]
+        return [(self.key, 1), ("_id", 1)]
+
+    def get_query(self, offset) -> dict:
+        """生成从 offset 之后开始的查询条件"""
+        if offset is None:
+            return self.filter_doc
+        if self.key == "_id":
+            key_filter = range_filter("_id", "$gt", offset, self.mixed_types)
+        else:
+            key_value, id_offset = offset
+            key_filter = {"$or": [range_filter(self.key, "$gt", key_value, self.mixed_types),
+                                  {"$and": [{self.key: key_value},
+                                            range_filter("_id", "$gt", id_offset, self.mixed_types)]}]}
+        return {"$and": [self.filter_doc, key_filter]} if self.filter_doc else key_filter
+
+    def get_offset(self, data: dict):
+        """获取文档的分页位置"""
+        if self.key == "_id":
+            return data.get("_id")
+        return get_key_value(data, self.key), data.get("_id")
+
+    def tune_page_size(self, elapsed: float):
+        """按目标耗时调整每页数量，每次最多翻倍或减半"""
+        if not self.target_latency:
+            return
+        ratio = min(max(self.target_latency / max(elapsed, 0.001), 0.5), 2.0)
+        self.page_size = int(min(max(self.page_size * ratio, self.min_page_size), self.max_page_size))
+
+    async def fetch_page(self, offset, page_size: int) -> list[dict]:
+        as_cursor = self.collection.find(self.get_query(offset), self.projection).sort(
+            self.get_sort()).limit(page_size)
+        if self.hint:
+            as_cursor = as_cursor.hint(self.hint)
+        if self.max_time_ms:
+            as_cursor = as_cursor.max_time_ms(self.max_time_ms)
+        start = time.monotonic()
+        try:
+            page = await as_cursor.to_list(length=page_size)
+        except PyMongoError as e:
+            raise AsMongoError(f"pymongo.errors.{e.__class__.__name__} {e.args}", err=e)
+        elapsed = time.monotonic() - start
+        if self.on_fetch:
+            self.on_fetch(page, elapsed)
+        # 返回的数量不足一页时不调整，避免最后一页影响
+        if len(page) >= page_size:
+            self.tune_page_size(elapsed)
+        return page
+
+    async def pages(self) -> AsyncIterator[list[dict]]:
+        """按页获取数据，每次返回一页后 self.offset 为该页最后的位置"""
+        next_task: asyncio.Task | None = None
+        try:
+            page_size = self.page_size
+            page = await self.fetch_page(self.offset, page_size)
+            while page:
+                offset = self.get_offset(page[-1])
+                is_last = len(page) < page_size
+                if not is_last and self.prefetch:
+                    page_size = self.page_size
+                    next_task = asyncio.create_task(self.fetch_page(offset, page_size))
+                self.offset = offset
+                yield page
+                if is_last:
+                    return
+                if next_task:
+                    page, next_task = await next_task, None
+                else:
+                    page_size = self.page_size
+                    page = await self.fetch_page(offset, page_size)
+        finally:
+            if next_task:
+                next_task.cancel()
+
+    async def __aiter__(self) -> AsyncIterator[dict]:
+        async for page in self.pages():
+            for data in page:
+                yield data
@@ -8,6 +8,7 @@ from pymongo import ASCENDING, DESCENDING
 from pymongo.results import DeleteResult
 
 from ..base import AsMongo, AsMongoError, TypeMongoId
+from .paginate import KeysetPaginator
 
 
 _direction = {
@@ -95,13 +96,18 @@ class MongoColl(AsMongo):
                 raise ValueError("filter_doc 和 id_offset 参数不能同时使用")
             if skip > 10000 or limit > 10000:
                 raise ValueError("skip 和 limit 不能大于 10000")
-            filter_doc.update({"id": {"$gt": id_offset}})
+            filter_doc.update({"_id": {"$gt": id_offset}})
         # as_cursor = self.collection.find({}, {"_id": 0, "uid": 1}).sort({"uid": 1}).skip(skip).limit(limit)
         as_cursor = self.collection.find(
             filter_doc, filter_key).sort([("_id", 1)]).skip(skip).limit(limit).max_time_ms(5000)
         async for data in as_cursor:
             yield DefaultMunch(**data)
 
+    def paginate(self, filter_doc: dict = None, projection: dict = None, *,
+                 key: str = "_id", **kwargs) -> KeysetPaginator:
+        """keyset 分页获取数据，参数参考 KeysetPaginator"""
+        return KeysetPaginator(self.collection, filter_doc, projection, key=key, **kwargs)
+
     async def count(self) -> int:
         """获取数据数量"""
         # estimated_document_count 这个才是db.collection.count() 命令
@@ -1,4 +1,11 @@
 
 __version__ = "0.0.0"
 
-from .core import run
+
+def __getattr__(name: str):
+    # 延迟导入 core，只 import framework（如获取 __version__）时不加载配置、日志和 mongo 相关模块
+    # 通过 run/run_repair 启动时仍然会导入 core，创建配置和 MongoOp（mongo 客户端在第一次使用时才创建）
+    if name in ("run", "run_repair"):
+        from . import core
+        return getattr(core, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,15 +1,24 @@
 import asyncio
+from contextlib import aclosing
 from typing import Final
 from pathlib import Path
 from bson.objectid import ObjectId
+from bson import json_util
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
 import aiofiles
 from loguru import logger
 from aiofiles.threadpool.text import AsyncTextIOWrapper
-from deepdiff import DeepDiff
 
-from commutils.asmongo import TypeMongoId
+from commutils.asmongo import AsMongoError, TypeMongoId
+from commutils.asmongo import KeysetPaginator
+from commutils.asmongo import range_filter, bson_sort_key, get_bson_type
+from .mongoclient import MongoOp
 from .mongoclient import mongo_src
 from .mongoclient import mongo_dst
+from .mongoclient import and_filter
+from . import metrics
+from . import profiling
 
 
 __all__ = ["DataCheck"]
@@ -34,7 +43,7 @@ def get_skip_id_obj(skip_id: str, skip_id_type: str) -> TypeMongoId:
     elif skip_id_type == "float":
         return float(skip_id)
     elif skip_id_type == "bool":
-        return bool(skip_id)
+        return skip_id == "True"
     else:
         raise ValueError("skip_id type error!!!")
 
@@ -44,16 +53,52 @@ def get_skip_id_meta(skip_id_obj: TypeMongoId) -> tuple[str, str]:
         return f"{skip_id_obj}", "ObjectId"
     elif isinstance(skip_id_obj, str):
         return skip_id_obj, "str"
+    elif isinstance(skip_id_obj, bool):
+        # bool 是 int 的子类，需要先判断
+        return f"{skip_id_obj}", "bool"
     elif isinstance(skip_id_obj, int):
         return f"{skip_id_obj}", "int"
     elif isinstance(skip_id_obj, float):
         return f"{skip_id_obj}", "float"
-    elif isinstance(skip_id_obj, bool):
-        return f"{skip_id_obj}", "bool"
     else:
         raise ValueError("skip_id_obj type error!!!")
 
 
+def format_result_id(data_id: TypeMongoId) -> str:
+    """结果文件中 _id 的格式: {json格式的_id}\t{_id类型}
+
+    _id 使用 mongodb extended json，字符串 _id 中的空格等不会影响解析。
+    """
+    try:
+        _, data_id_type = get_skip_id_meta(data_id)
+    except ValueError:
+        data_id_type = type(data_id).__name__
+    return f"{json_util.dumps(data_id)}\t{data_id_type}"
+
+
+def parse_result_id(line: str) -> TypeMongoId:
+    """从结果文件的一行中解析 _id，格式错误时 raise ValueError
+
+    兼容旧格式: {_id} {_id类型} {DeepDiff结果}
+    """
+    line = line.rstrip('\n')
+    if '\t' in line:
+        return json_util.loads(line.split('\t', 1)[0])
+    line_l = line.split(' ', 2)
+    if len(line_l) < 2:
+        raise ValueError(f"结果文件内容格式错误: {line}")
+    return get_skip_id_obj(line_l[0], line_l[1])
+
+
+def deep_diff(src_data: dict, dst_data: dict):
+    """对比不一致数据的差异，在线程中执行
+
+    deepdiff 导入比较慢，只在数据不一致时在线程中导入，不阻塞事件循环。
+    """
+    from deepdiff import DeepDiff
+    return DeepDiff(src_data, dst_data)
+
+
 class DataCheck:
     concurrent: int = 50
 
@@ -63,24 +108,56 @@ class DataCheck:
     result_path: Path = Path("result")
 
     def __init__(self, *, db_name: str, collection: str,
-                 concurrent: int = None
+                 concurrent: int = None,
+                 src: MongoOp = None,
+                 id_ranges: list[tuple[TypeMongoId, TypeMongoId]] = None,
+                 tag: str = None,
+                 filter_doc: dict = None,
+                 hint: str | dict = None,
+                 sort_key: str = None,
                  ):
+        """
+        src        读取源数据的 MongoOp，默认 mongo_src（分片检查时为直连的分片）
+        id_ranges  只检查这些 [min_id, max_id) 区间，需按 _id 排序，默认检查全部
+        tag        结果文件名的标记，用于区分同一个集合的多个检查任务
+        filter_doc 只检查符合条件的数据，源和目标获取数据时都会使用
+        hint       获取 _id 列表时使用的索引
+        sort_key   按 (sort_key, _id) 顺序检查，断点记录 sort_key 的值，默认按 _id 检查
+        """
         # raise RuntimeError(f"{self.__class__} 不允许实力化。")
         self.db_name: Final[str] = db_name
         self.collection: Final[str] = collection
 
         self.concurrent = concurrent or self.concurrent
+        self.src: Final[MongoOp] = src or mongo_src
+        self.id_ranges = id_ranges
+        self.tag: Final[str] = tag
+        self.filter_doc: Final[dict] = filter_doc
+        self.hint: Final[str | dict] = hint
+        self.sort_key: Final[str] = sort_key
+        self.ns: Final[str] = f"{db_name}.{collection}"
+        # _id 是否有多种 BSON 类型，启动时检查，只有一种类型时分页不添加跨类型的查询条件
+        self.mixed_id_types: bool = True
+        # 只有一种类型时 _id 的 BSON 类型
+        self.id_type: str | None = None
+        self.progress = metrics.get_progress(self.ns)
 
         # self.skip_id: str = ""
         # self.skip_id_type: str = ""
         self.skip_id_obj: TypeMongoId = None
+        # 按 sort_key 检查时的断点 (sort_key值, _id)
+        self.skip_key_obj: tuple[object, TypeMongoId] = None
         self.result_path.mkdir(exist_ok=True)
         pre_path = self.result_path.as_posix()
-        self.skip_id_file: Final[str] = f'{pre_path}/{db_name}.{collection}.skip.txt'
-        self.check_success_file: Final[str] = f'{pre_path}/{db_name}.{collection}.check.success.txt'
-        self.check_failure_file: Final[str] = f'{pre_path}/{db_name}.{collection}.check.failure.txt'
+        name = f"{db_name}.{collection}.{tag}" if tag else f"{db_name}.{collection}"
+        self.skip_id_file: Final[str] = f'{pre_path}/{name}.skip.txt'
+        self.skip_key_file: Final[str] = f'{pre_path}/{name}.skip.key.txt'
+        self.check_success_file: Final[str] = f'{pre_path}/{name}.check.success.txt'
+        self.check_failure_file: Final[str] = f'{pre_path}/{name}.check.failure.txt'
 
     def __repr__(self):
+        if self.tag:
+            return f"<{self.__class__.__name__} {self.db_name}.{self.collection} {self.tag}>"
         return f"<{self.__class__.__name__} {self.db_name}.{self.collection}>"
 
     async def read_skip_id_from_file(self):
@@ -117,27 +194,55 @@ class DataCheck:
         async with aiofiles.open(self.skip_id_file, mode='w') as f:
             await f.write(f"{skip_id}\t{skip_id_type}")
 
+    async def read_skip_key_from_file(self):
+        """读取按 sort_key 检查的断点"""
+        try:
+            async with aiofiles.open(self.skip_key_file, mode='r') as f:
+                skip_detail = json_util.loads(await f.read())
+            self.skip_key_obj = (skip_detail["key"], skip_detail["_id"])
+            self.skip_id_obj = skip_detail["_id"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            logger.warning(f"{self.skip_key_file} 文件内容错误。")
+        logger.info(f"mongo数据从 {self.sort_key} {self.skip_key_obj} 开始处理。")
+
+    async def write_skip_key_to_file(self):
+        key_value, skip_id = self.skip_key_obj
+        async with aiofiles.open(self.skip_key_file, mode='w') as f:
+            await f.write(json_util.dumps({"key": key_value, "_id": skip_id}))
+
     async def print_check_id_data(self, data_id: TypeMongoId):
         src_data, dst_data = await asyncio.gather(
-            mongo_src.find_id_info(data_id, self.collection, self.db_name),
-            mongo_dst.find_id_info(data_id, self.collection, self.db_name)
+            self.src.find_id_info(data_id, self.collection, self.db_name, filter_doc=self.filter_doc),
+            mongo_dst.find_id_info(data_id, self.collection, self.db_name, filter_doc=self.filter_doc)
         )
         if not src_data or not dst_data:
             print("no data mongo two.")
             return
-        print(f"check {data_id}:", await asyncio.to_thread(DeepDiff, src_data, dst_data))
+        print(f"check {data_id}:", await asyncio.to_thread(deep_diff, src_data, dst_data))
+
+    async def find_id_info(self, mongo: MongoOp, stage: str, data_id: TypeMongoId) -> dict:
+        with profiling.stage(self.ns, stage):
+            return await mongo.find_id_info(data_id, self.collection, self.db_name, filter_doc=self.filter_doc)
 
     async def check_id_data(self, data_id: TypeMongoId):
         src_data, dst_data = await asyncio.gather(
-            mongo_src.find_id_info(data_id, self.collection, self.db_name),
-            mongo_dst.find_id_info(data_id, self.collection, self.db_name)
+            self.find_id_info(self.src, "src_fetch", data_id),
+            self.find_id_info(mongo_dst, "dst_fetch", data_id)
         )
-        data_id_str, data_id_type = get_skip_id_meta(data_id)
-        if src_data == dst_data:
-            await self.check_success_fobj.write(f"{data_id_str} {data_id_type}\n")
+        result_id = format_result_id(data_id)
+        metrics.docs_checked.inc(ns=self.ns)
+        with profiling.stage(self.ns, "compare", cpu=True):
+            is_equal = src_data == dst_data
+        if is_equal:
+            with profiling.stage(self.ns, "write"):
+                await self.check_success_fobj.write(f"{result_id}\n")
         else:
-            result = await asyncio.to_thread(DeepDiff, src_data, dst_data)
-            await self.check_failure_fobj.write(f"{data_id_str} {data_id_type} {result}\n")
+            metrics.mismatches.inc(ns=self.ns)
+            result = await asyncio.to_thread(profiling.timed_call, self.ns, "deepdiff", deep_diff, src_data, dst_data)
+            with profiling.stage(self.ns, "write"):
+                await self.check_failure_fobj.write(f"{result_id}\t{result}\n")
 
     async def flush_fobj_and_close(self):
         await self.check_success_fobj.flush()
@@ -151,7 +256,10 @@ class DataCheck:
         #     logger.error("cls.user_count error.")
         #     return
 
-        await self.read_skip_id_from_file()
+        if self.sort_key:
+            await self.read_skip_key_from_file()
+        else:
+            await self.read_skip_id_from_file()
 
         if not self.skip_id_obj:
             # 清空结果文件
@@ -171,30 +279,139 @@ class DataCheck:
         """只是测试用的"""
         await self.check_id_data(data_id)
 
+    async def check_pages(self, paginator: KeysetPaginator):
+        """按页检查数据，预取下一页的同时检查当前页，每页检查完成后记录断点"""
+        # 检查出错时关闭分页，取消后台预取下一页的任务
+        async with aclosing(paginator.pages()) as pages:
+            async for page in pages:
+                logger.info(f"检查 {self} 从 {paginator.key} "
+                            f"{self.skip_key_obj if self.sort_key else self.skip_id_obj} 开始的 {len(page)} 条数据...")
+                await asyncio.gather(*[self.check_id_data(data.get("_id")) for data in page])
+                with profiling.stage(self.ns, "write"):
+                    await self.check_success_fobj.flush()
+                    await self.check_failure_fobj.flush()
+                self.skip_id_obj = page[-1].get("_id")
+                self.progress.update(len(page), self.skip_id_obj)
+                if self.sort_key:
+                    self.skip_key_obj = paginator.offset
+                    await self.write_skip_key_to_file()
+                else:
+                    await self.write_skip_id_to_file()
+
+    def id_range_filter(self, op: str, value: TypeMongoId) -> dict:
+        """_id 的范围条件
+
+        _id 只有一种类型时不添加跨类型的条件，但边界值（如 chunk 的边界）的类型和 _id 不同时仍然需要，
+        否则 mongodb 只比较同一类型的值，不会匹配任何数据。MinKey/MaxKey 和所有类型都可以比较。
+        """
+        mixed_types = self.mixed_id_types or get_bson_type(value) not in (None, self.id_type)
+        return range_filter("_id", op, value, mixed_types)
+
+    async def check_id_range(self, id_min: TypeMongoId, id_max: TypeMongoId):
+        """检查 [id_min, id_max) 区间的数据，边界可以是 MinKey/MaxKey"""
+        skip_key = bson_sort_key(self.skip_id_obj) if self.skip_id_obj is not None else None
+        if skip_key is not None and skip_key >= bson_sort_key(id_max):
+            # 断点之前已经检查完成的区间
+            return
+        id_offset = self.skip_id_obj if skip_key is not None and skip_key >= bson_sort_key(id_min) else None
+        await self.check_pages(self.src.get_id_paginator(
+            self.collection, self.db_name, offset=id_offset,
+            filter_doc=and_filter(self.id_range_filter("$gte", id_min),
+                                  self.id_range_filter("$lt", id_max),
+                                  self.filter_doc),
+            hint=self.hint, page_size=self.concurrent, mixed_types=self.mixed_id_types))
+
+    def get_resumed_filter(self) -> dict | None:
+        """断点之前已经检查过的数据的查询条件，没有断点时返回 None"""
+        if self.sort_key:
+            if self.skip_key_obj is None:
+                return None
+            key_value, skip_id = self.skip_key_obj
+            resumed_filter = {"$or": [range_filter(self.sort_key, "$lt", key_value),
+                                      {"$and": [{self.sort_key: key_value},
+                                                self.id_range_filter("$lte", skip_id)]}]}
+        elif self.skip_id_obj is not None:
+            resumed_filter = self.id_range_filter("$lte", self.skip_id_obj)
+            if self.id_ranges is not None:
+                resumed_filter = and_filter(resumed_filter, {"$or": [
+                    and_filter(self.id_range_filter("$gte", id_min),
+                               self.id_range_filter("$lt", id_max))
+                    for id_min, id_max in self.id_ranges]})
+        else:
+            return None
+        return and_filter(resumed_filter, self.filter_doc)
+
+    async def init_progress(self, total_filter: dict | None):
+        """开启指标统计时，获取需要检查的数量和断点之前已经检查的数量，用于计算进度和预计剩余时间
+
+        total_filter 为需要检查的数据的查询条件，为空时使用集合的估算数量
+        """
+        if not metrics.enabled:
+            return
+        try:
+            if not self.progress.total:
+                self.progress.total = await mongo_src.count_id(self.collection, self.db_name,
+                                                               filter_doc=total_filter)
+            if (resumed_filter := self.get_resumed_filter()) is not None:
+                self.progress.resumed += await self.src.count_id(self.collection, self.db_name,
+                                                                 filter_doc=resumed_filter)
+        except AsMongoError as e:
+            # 只影响进度统计，不中断检查
+            logger.warning(f"{self} 获取检查数量错误: {e}")
+        self.progress.set_gauges()
+
+    async def get_id_edges(self) -> tuple[TypeMongoId, TypeMongoId]:
+        """获取第一个和最后一个 _id，并检查 _id 是否有多种 BSON 类型
+
+        按 _id 排序时同一类型的值排在一起，第一个和最后一个 _id 的类型相同时所有 _id 都是这个类型。
+        没有数据时返回 (None, None)。
+        """
+        try:
+            first_id, last_id = await asyncio.gather(
+                self.src.get_first_id(self.collection, self.db_name, filter_doc=self.filter_doc, hint=self.hint),
+                self.src.get_last_id(self.collection, self.db_name, filter_doc=self.filter_doc, hint=self.hint))
+        except AsMongoError as e:
+            # 和 find_edge_id 的超时条件相同：只按 _id 索引查询时出错直接报错
+            if not self.filter_doc and not self.hint:
+                raise
+            # hint 不是 {等值字段..., _id: 1} 索引时按 _id 排序是内存排序，可能超时，不限制最大 _id
+            logger.warning(f"{self} 获取第一个和最后的 _id 错误，检查到最新的数据: {e}")
+            return MinKey(), MaxKey()
+        self.mixed_id_types = get_bson_type(first_id) != get_bson_type(last_id)
+        self.id_type = None if self.mixed_id_types else get_bson_type(first_id)
+        if self.mixed_id_types:
+            logger.info(f"{self} 的 _id 有多种类型: {type(first_id)} {type(last_id)}")
+        return first_id, last_id
+
     async def start(self):
-        logger.info(f"启动检测 {self.db_name}.{self.collection} ...")
+        logger.info(f"启动检测 {self} ...")
         await self.init_check_files()
 
-        max_id_obj = await mongo_src.get_last_id(self.collection, self.db_name)
-        # assert isinstance(max_user_id, str), f"zmwz_src.get_last_id(): {max_user_id} error."
-        while not self.skip_id_obj \
-                or self.skip_id_obj < max_id_obj:
-            logger.info(f"检查 mongo_src 从 _id {self.skip_id_obj} 开始的 {self.concurrent} 条数据...")
-            tasks = []
-            last_coll_id = [None]
-            async for data in mongo_src.get_list_by_id(
-                    id_offset=self.skip_id_obj, limit=self.concurrent,
-                    collection=self.collection, db_name=self.db_name):
-                try:
-                    last_coll_id[0] = data.get("_id")
-                except ValueError:
-                    logger.error(f"mongo_src {self.db_name}.{self.collection} "
-                                 f"_id（{last_coll_id[0]}） {data} 错误。")
-                    return
-                assert last_coll_id[0], f"mongo_src user _id（{last_coll_id}） 错误。"
-                tasks.append(self.check_id_data(last_coll_id[0]))
-            await asyncio.gather(*tasks)
-            await self.check_success_fobj.flush()
-            await self.check_failure_fobj.flush()
-            self.skip_id_obj = last_coll_id[0]
-            await self.write_skip_id_to_file()
+        if self.id_ranges is not None:
+            await self.get_id_edges()
+            # 分片检查的多个任务共用集合的进度，total 为整个集合需要检查的数量
+            await self.init_progress(self.filter_doc)
+            for id_min, id_max in self.id_ranges:
+                await self.check_id_range(id_min, id_max)
+        elif self.sort_key:
+            await self.init_progress(self.filter_doc)
+            # 按 (sort_key, _id) 顺序检查，适合只检查某个索引范围的数据
+            await self.check_pages(self.src.get_id_paginator(
+                self.collection, self.db_name, key=self.sort_key, offset=self.skip_key_obj,
+                filter_doc=self.filter_doc, hint=self.hint, page_size=self.concurrent))
+        else:
+            # 只检查到启动时最后的 _id，避免一直追新写入的数据
+            _, max_id_obj = await self.get_id_edges()
+            self.progress.last_id = max_id_obj
+            if max_id_obj is None:
+                logger.info(f"{self} 没有需要检查的数据。")
+            else:
+                # 没有 filter_doc 时使用集合的估算数量
+                await self.init_progress(and_filter(self.id_range_filter("$lte", max_id_obj),
+                                                    self.filter_doc) if self.filter_doc else None)
+                await self.check_pages(self.src.get_id_paginator(
+                    self.collection, self.db_name, offset=self.skip_id_obj,
+                    filter_doc=and_filter(self.id_range_filter("$lte", max_id_obj),
+                                          self.filter_doc),
+                    hint=self.hint, page_size=self.concurrent, mixed_types=self.mixed_id_types))
+        await self.flush_fobj_and_close()
@@ -17,6 +17,7 @@ from typing import Literal
 from functools import lru_cache
 from pydantic import BaseSettings, BaseConfig
 from pydantic import MongoDsn
+from bson import json_util
 
 __all__ = ["get_settings", "Settings",
            # "STATIS_SETTINGS",
@@ -56,6 +57,9 @@ class Settings(BaseSettings):
         def parse_env_var(cls, field_name: str, raw_val: str):
             if field_name in ['check_dbs', 'check_collections']:
                 return [x for x in raw_val.split(',')]
+            if field_name == 'check_filters':
+                # 支持 mongodb extended json，如 {"$date": "2023-01-01T00:00:00Z"}
+                return json_util.loads(raw_val)
             return cls.json_loads(raw_val)
 
     log_level: Literal["DEBUG", "INFO", "WARNING", "ERROR"] = "INFO"
@@ -67,6 +71,45 @@ class Settings(BaseSettings):
 
     task_concurrent: int = 2
     check_batch_size: int = 50
+    # 每页获取 _id 的目标耗时（秒），设置后按耗时自动调整 check_batch_size，0 为不调整
+    check_target_latency: float = 0
+    # 自动调整时 check_batch_size 的最大值
+    check_max_batch_size: int = 1000
+    # 获取集合名称时同时请求的库数量
+    list_concurrent: int = 20
+
+    # 指标的 http 接口端口（/metrics 和 /metrics.json），0 为不开启
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0
+    # 定时写入 result/metrics.json 指标快照的间隔（秒），0 为不写入
+    metrics_snapshot_interval: int = 0
+
+    # 统计每个集合各阶段的耗时，结束时输出 result/profile.report.txt
+    profile_stages: bool = False
+    # 开启 cProfile 和协程调用栈采样的秒数，0 为不开启，结果输出到 result/profile.*
+    profiler_seconds: int = 0
+    # 启动后多少秒开始性能分析
+    profiler_delay: int = 0
+
+    # 按集合配置的部分检查，key 为 db.collection
+    # 只检查符合条件的数据
+    check_filters: dict[str, dict] = {}
+    # 获取 _id 列表时使用的索引，索引名称或 {字段: 1, ...} 索引键
+    # 没有配置 check_sort_keys 时需要 {等值字段..., _id: 1} 的索引，获取最后的 _id 时才不会内存排序
+    check_hints: dict[str, str | dict[str, int]] = {}
+    # 按 (字段, _id) 顺序检查，断点记录该字段的值，应与 check_hints 的索引对应
+    check_sort_keys: dict[str, str] = {}
+
+    # 源为分片集群时，按 chunk 范围分片检查
+    shard_aware: bool = False
+    # 分片检查时直连分片副本集读取源数据
+    shard_direct_read: bool = True
+
+    # 检查完成后修复目标库中不一致的数据
+    repair: bool = False
+    repair_batch_size: int = 500
+    # 每秒最多修复的文档数，0 为不限制
+    repair_rate_limit: int = 0
 
 
 @lru_cache()
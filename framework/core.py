@@ -1,3 +1,4 @@
+import json
 import asyncio
 
 from aslooper import looper
@@ -12,10 +13,16 @@ except ImportError:
             pass
     uvloop = __Uvloop
 
+from commutils.asmongo import AsMongoError
 from .logs import logger
+from .logs import init_logger
 from .config import get_settings
 from .mongoclient import mongo_src
 from .checkcoll import DataCheck
+from .shardcheck import ShardDataCheck
+from .repair import DataRepair
+from . import metrics
+from . import profiling
 
 settings = get_settings()
 
@@ -24,6 +31,19 @@ settings = get_settings()
 #     loop.run_until_complete(CheckMain.flush_fobj_and_close())
 
 
+async def get_dbs_coll_name(dbs: list[str]) -> list[str]:
+    """并发获取多个库的集合名称"""
+    sem = asyncio.Semaphore(settings.list_concurrent)
+
+    async def get_db_coll_name(db: str) -> list[str]:
+        async with sem:
+            coll_s = await mongo_src.get_collection_names(db)
+        return [f"{db}.{c}" for c in coll_s]
+
+    results = await asyncio.gather(*[get_db_coll_name(db) for db in dbs])
+    return [coll_string for coll_s in results for coll_string in coll_s]
+
+
 async def get_all_check_coll_name() -> list[str]:
     all_collection_string: list[str] = []
     filter_dbs = settings.check_dbs
@@ -33,14 +53,10 @@ async def get_all_check_coll_name() -> list[str]:
         all_collection_string.extend(filter_collections)
 
     if filter_dbs:
-        for db in filter_dbs:
-            coll_s = await mongo_src.get_collection_names(db)
-            all_collection_string.extend([f"{db}.{c}" for c in coll_s])
+        all_collection_string.extend(await get_dbs_coll_name(filter_dbs))
     elif not filter_collections:
         all_dbs = await mongo_src.get_db_names()
-        for db in all_dbs:
-            coll_s = await mongo_src.get_collection_names(db)
-            all_collection_string.extend([f"{db}.{c}" for c in coll_s])
+        all_collection_string.extend(await get_dbs_coll_name(all_dbs))
     all_collection_string = list(set(all_collection_string))
     return all_collection_string
 
@@ -53,26 +69,135 @@ def get_coll_meta(db_coll_string: str) -> tuple[str, str]:
     return data_l[0], data_l[1]
 
 
+async def check_coll(db: str, coll: str, shard_aware: bool = False):
+    """检查一个集合，配置了 repair 时检查完成后修复"""
+    filter_doc = settings.check_filters.get(f"{db}.{coll}")
+    hint = settings.check_hints.get(f"{db}.{coll}")
+    sort_key = settings.check_sort_keys.get(f"{db}.{coll}")
+    # 按 sort_key 检查时不能按 _id 的 chunk 范围规划
+    if shard_aware and not sort_key:
+        await ShardDataCheck(db_name=db, collection=coll,
+                             concurrent=settings.check_batch_size,
+                             direct_read=settings.shard_direct_read,
+                             filter_doc=filter_doc, hint=hint).start()
+    else:
+        await DataCheck(db_name=db, collection=coll,
+                        concurrent=settings.check_batch_size,
+                        filter_doc=filter_doc, hint=hint, sort_key=sort_key).start()
+    if settings.repair:
+        await DataRepair(db_name=db, collection=coll,
+                         batch_size=settings.repair_batch_size,
+                         rate_limit=settings.repair_rate_limit).start()
+
+
+def log_task_error(task: asyncio.Task):
+    """后台任务异常退出时记录日志，避免错误在结束时才被忽略"""
+    if not task.cancelled() and (e := task.exception()):
+        logger.opt(exception=e).error(f"后台任务 {task.get_name()} 错误: {e!r}")
+
+
+async def start_metrics() -> list[asyncio.Task]:
+    """按配置启动指标接口和快照，返回后台任务
+
+    指标接口在这里监听，端口被占用等错误在启动时直接 raise。
+    """
+    if not settings.metrics_port and not settings.metrics_snapshot_interval:
+        return []
+    metrics.enable()
+    tasks = []
+    if settings.metrics_port:
+        server = await metrics.start_server(settings.metrics_host, settings.metrics_port)
+        # 任务取消时 serve_forever 会关闭 server
+        tasks.append(asyncio.create_task(server.serve_forever(), name="metrics-http"))
+    tasks.append(asyncio.create_task(metrics.monitor_loop_lag(), name="metrics-loop-lag"))
+    if settings.metrics_snapshot_interval:
+        tasks.append(asyncio.create_task(metrics.write_snapshot_forever(
+            DataCheck.result_path / "metrics.json", settings.metrics_snapshot_interval), name="metrics-snapshot"))
+    return tasks
+
+
 # @looper(__sig_cancel_run)
 @looper()
 async def main():
     logger.info("start...")
-
+    DataCheck.result_path.mkdir(exist_ok=True)
+    background_tasks = await start_metrics()
+    if settings.profile_stages:
+        profiling.enable()
+    if settings.profiler_seconds:
+        background_tasks.append(asyncio.create_task(profiling.profile_window(
+            settings.profiler_seconds, DataCheck.result_path / "profile",
+            delay=settings.profiler_delay), name="profiler"))
+    for task in background_tasks:
+        task.add_done_callback(log_task_error)
+    try:
+        await check_all()
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        # 等待后台任务处理取消（如性能分析写入结果文件）
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        if settings.metrics_snapshot_interval:
+            (DataCheck.result_path / "metrics.json").write_text(
+                json.dumps(metrics.snapshot(), ensure_ascii=False, indent=2))
+        if settings.profile_stages:
+            profile_report = profiling.report()
+            logger.info(f"各阶段耗时:\n{profile_report}")
+            (DataCheck.result_path / "profile.report.txt").write_text(profile_report)
+
+
+async def check_all():
+    """检查所有需要检查的集合"""
     sem = asyncio.Semaphore(settings.task_concurrent)
     all_coll_s = await get_all_check_coll_name()
 
+    shard_aware = settings.shard_aware and await mongo_src.is_mongos()
+    if shard_aware:
+        logger.info("mongo_src 为分片集群，按 chunk 范围分片检查。")
+        if settings.shard_direct_read:
+            try:
+                if await mongo_src.is_balancer_running():
+                    logger.warning("balancer 正在运行，检查过程中 chunk 迁移可能导致直连分片的检查结果不准确。")
+            except AsMongoError as e:
+                # 只用于提示，没有权限等错误不影响检查
+                logger.warning(f"获取 balancer 状态错误: {e}")
+
+    async def check_coll_with_sem(db: str, coll: str):
+        # 每个集合的检查任务都受 task_concurrent 限制
+        async with sem:
+            await check_coll(db, coll, shard_aware)
+
     logger.info(f'检查目标 {all_coll_s}')
-    async with sem:
-        async with asyncio.TaskGroup() as tg:
-            for coll_string in all_coll_s:
-                logger.debug(f"创建 {coll_string} 对比任务")
-                db, coll = get_coll_meta(coll_string)
-                tg.create_task(DataCheck(
-                    db_name=db, collection=coll,
-                    concurrent=settings.check_batch_size).start(), name=f"DataCheck-{db}.{coll}")
+    async with asyncio.TaskGroup() as tg:
+        for coll_string in all_coll_s:
+            logger.debug(f"创建 {coll_string} 对比任务")
+            db, coll = get_coll_meta(coll_string)
+            tg.create_task(check_coll_with_sem(db, coll), name=f"DataCheck-{db}.{coll}")
+
+
+@looper()
+async def main_repair():
+    """只根据已有的检查结果文件修复"""
+    logger.info("start repair...")
+    filter_dbs = settings.check_dbs
+    filter_collections = settings.check_collections
+    for db, coll in DataRepair.get_failure_colls():
+        if (filter_dbs or filter_collections) \
+                and db not in filter_dbs and f"{db}.{coll}" not in filter_collections:
+            continue
+        await DataRepair(db_name=db, collection=coll,
+                         batch_size=settings.repair_batch_size,
+                         rate_limit=settings.repair_rate_limit).start()
 
 
 def run():
+    init_logger()
     uvloop.install()
     # Python 3.7 required
     asyncio.run(main())
+
+
+def run_repair():
+    init_logger()
+    uvloop.install()
+    asyncio.run(main_repair())
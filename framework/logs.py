@@ -1,17 +1,19 @@
 
-__all__ = ["logger"]
+__all__ = ["logger", "init_logger"]
 
 from sys import stderr
 from loguru import logger
 
 from .config import get_settings
 
-settings = get_settings()
 
-logger.configure(
-    handlers=[
-        dict(sink=stderr, level=settings.log_level, enqueue=True),
-        # dict(sink=stderr, level="INFO", enqueue=True),
-        # dict(sink="file_{time}.log", enqueue=True, serialize=True, rotation="500 MB", retention=5, level="INFO")
-    ]
-)
+def init_logger():
+    """配置日志输出，在启动程序时调用"""
+    settings = get_settings()
+    logger.configure(
+        handlers=[
+            dict(sink=stderr, level=settings.log_level, enqueue=True),
+            # dict(sink=stderr, level="INFO", enqueue=True),
+            # dict(sink="file_{time}.log", enqueue=True, serialize=True, rotation="500 MB", retention=5, level="INFO")
+        ]
+    )
@@ -0,0 +1,256 @@
+"""
+检查过程的指标统计
+
+统计检查的文档数、不一致数、每个库读取的字节数、MongoOp 每个方法的查询耗时、事件循环延迟，
+以及每个集合的进度和预计剩余时间。
+
+可以通过 http 接口获取（prometheus 文本格式 /metrics，json 格式 /metrics.json），
+也可以定时写入 json 快照文件。
+"""
+import time
+import json
+import asyncio
+import functools
+from typing import Final
+from pathlib import Path
+import aiofiles
+from loguru import logger
+
+
+__all__ = [
+    "enabled", "enable",
+    "docs_checked", "mismatches", "bytes_read", "query_latency", "loop_lag",
+    "timed", "get_progress",
+    "render_prometheus", "snapshot",
+    "start_server", "serve", "monitor_loop_lag", "write_snapshot_forever",
+]
+
+# 未开启时不统计需要额外计算的指标（如读取的字节数）
+enabled: bool = False
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+class Metric:
+    type: str = ""
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name: Final[str] = name
+        self.doc: Final[str] = doc
+        self.labels: Final[tuple[str, ...]] = labels
+        _registry.append(self)
+
+    def label_key(self, labels: dict) -> tuple:
+        return tuple(f"{labels.get(k, '')}" for k in self.labels)
+
+    def format_labels(self, key: tuple, **extra) -> str:
+        items = [*zip(self.labels, key), *extra.items()]
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, doc, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{self.format_labels(k)} {v}" for k, v in self.values.items()]
+
+    def snapshot(self) -> dict:
+        return {",".join(k): v for k, v in self.values.items()}
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self.label_key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+    buckets: tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, doc, labels)
+        # {labels: [每个 bucket 的数量, ..., count, sum]}
+        self.values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.label_key(labels)
+        data = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                data[i] += 1
+        data[-2] += 1
+        data[-1] += value
+
+    def render(self) -> list[str]:
+        lines = []
+        for k, data in self.values.items():
+            for bucket, count in zip(self.buckets, data):
+                lines.append(f"{self.name}_bucket{self.format_labels(k, le=bucket)} {count}")
+            lines.append(f"{self.name}_bucket{self.format_labels(k, le='+Inf')} {data[-2]}")
+            lines.append(f"{self.name}_count{self.format_labels(k)} {data[-2]}")
+            lines.append(f"{self.name}_sum{self.format_labels(k)} {data[-1]}")
+        return lines
+
+    def snapshot(self) -> dict:
+        return {",".join(k): dict(count=data[-2], sum=data[-1],
+                                  avg=data[-1] / data[-2] if data[-2] else 0)
+                for k, data in self.values.items()}
+
+
+_registry: list[Metric] = []
+
+docs_checked = Counter("mongocheckd_docs_checked_total", "检查的文档数", ("ns",))
+mismatches = Counter("mongocheckd_mismatches_total", "不一致的文档数", ("ns",))
+bytes_read = Counter("mongocheckd_bytes_read_total", "读取文档的字节数", ("side", "ns"))
+query_latency = Histogram("mongocheckd_query_seconds", "MongoOp 方法的查询耗时", ("side", "method"))
+loop_lag = Histogram("mongocheckd_loop_lag_seconds", "事件循环延迟")
+progress_ratio = Gauge("mongocheckd_progress_ratio", "集合检查进度", ("ns",))
+eta_seconds = Gauge("mongocheckd_eta_seconds", "集合检查预计剩余时间", ("ns",))
+
+
+def timed(method):
+    """统计 MongoOp 协程方法的耗时，按 self.name 区分源和目标"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            query_latency.observe(time.monotonic() - start, side=self.name, method=method.__name__)
+    return wrapper
+
+
+class CollProgress:
+    """集合的检查进度
+
+    total 为需要检查的文档数（没有 filter_doc 时为估算值），resumed 为断点之前已经检查的文档数，
+    按本次检查的文档数和速度计算预计剩余时间。
+    """
+    def __init__(self, ns: str):
+        self.ns: Final[str] = ns
+        self.total: int = 0
+        self.resumed: int = 0
+        self.checked: int = 0
+        self.current_id = None
+        self.last_id = None
+        self.start_time: float = time.monotonic()
+
+    def update(self, checked: int, current_id=None):
+        self.checked += checked
+        self.current_id = current_id
+        self.set_gauges()
+
+    def set_gauges(self):
+        progress_ratio.set(self.ratio, ns=self.ns)
+        if (eta := self.eta) is not None:
+            eta_seconds.set(eta, ns=self.ns)
+
+    @property
+    def ratio(self) -> float:
+        return min((self.resumed + self.checked) / self.total, 1.0) if self.total else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        elapsed = time.monotonic() - self.start_time
+        if not self.checked or not self.total or not elapsed:
+            return None
+        return max(self.total - self.resumed - self.checked, 0) / (self.checked / elapsed)
+
+    def snapshot(self) -> dict:
+        elapsed = time.monotonic() - self.start_time
+        return dict(total=self.total, resumed=self.resumed, checked=self.checked,
+                    current_id=f"{self.current_id}", last_id=f"{self.last_id}",
+                    ratio=self.ratio, eta_seconds=self.eta,
+                    docs_per_second=self.checked / elapsed if elapsed else 0)
+
+
+_progress: dict[str, CollProgress] = {}
+
+
+def get_progress(ns: str) -> CollProgress:
+    if ns not in _progress:
+        _progress[ns] = CollProgress(ns)
+    return _progress[ns]
+
+
+def render_prometheus() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.doc}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> dict:
+    return dict(time=time.time(),
+                metrics={metric.name: metric.snapshot() for metric in _registry},
+                progress={ns: p.snapshot() for ns, p in _progress.items()})
+
+
+async def handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # 丢弃请求头
+        while (await reader.readline()).strip():
+            pass
+        path = request_line.decode(errors="ignore").split(" ")[1] if request_line else ""
+        if path == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4", render_prometheus()
+        elif path == "/metrics.json":
+            status, content_type, body = "200 OK", "application/json", json.dumps(snapshot(), ensure_ascii=False)
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+        body = body.encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (ConnectionError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host: str, port: int) -> asyncio.Server:
+    """监听指标的 http 接口，端口被占用等错误直接 raise"""
+    server = await asyncio.start_server(handle_http, host, port)
+    logger.info(f"指标接口 http://{host}:{port}/metrics")
+    return server
+
+
+async def serve(host: str, port: int):
+    """启动指标的 http 接口"""
+    server = await start_server(host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def monitor_loop_lag(interval: float = 0.5):
+    """统计事件循环延迟：sleep 实际耗时超过 interval 的部分"""
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(time.monotonic() - start - interval, 0))
+
+
+async def write_snapshot_forever(path: Path, interval: float):
+    """定时写入 json 指标快照"""
+    while True:
+        await asyncio.sleep(interval)
+        async with aiofiles.open(path, mode='w') as f:
+            await f.write(json.dumps(snapshot(), ensure_ascii=False, indent=2))
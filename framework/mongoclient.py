@@ -1,14 +1,35 @@
-from typing import AsyncIterable
+import re
+import functools
+from typing import Final
+from urllib.parse import parse_qsl, urlencode
+import bson
 from munch import DefaultMunch
+from pymongo.results import BulkWriteResult
 from loguru import logger
 from commutils.asmongo import AsMongo, AsMongoError, TypeMongoId
+from commutils.asmongo import KeysetPaginator, bson_hash_key
 from .config import get_settings
+from . import metrics
+from . import profiling
+from .metrics import timed
 
 settings = get_settings()
 
 
 class MongoOp(AsMongo):
 
+    def __init__(self, uri: str = "", *, name: str = "", **kwargs):
+        """name 用于指标统计区分源和目标，其他参数参考 AsMongo"""
+        super().__init__(uri, **kwargs)
+        self.name: Final[str] = name
+
+    def record_bytes_read(self, docs: list[dict], collection: str, db_name: str = None):
+        """开启指标统计时，统计读取文档的字节数"""
+        if metrics.enabled and docs:
+            metrics.bytes_read.inc(sum(len(bson.encode(doc)) for doc in docs if doc),
+                                   side=self.name, ns=f"{db_name}.{collection}")
+
+    @timed
     async def get_db_names(self) -> list[str]:
         """获取所有db名称 （排除 config admin local）"""
         dbs: list[str] = await self.connect(self.client.list_database_names())
@@ -20,31 +41,40 @@ class MongoOp(AsMongo):
             pass
         return dbs
 
+    @timed
     async def get_collection_names(self, db_name: str) -> list[str]:
+        """获取库中所有集合名称（排除视图和 system.* 集合）"""
         db = self.client.get_database(db_name) if db_name else self.db
-        return await self.connect(db.list_collection_names())
-
-    async def get_list_by_id(self, collection: str, db_name: str = None, *,
-                             id_offset: TypeMongoId = "",
-                             skip: int = 0, limit: int = 50) -> AsyncIterable[DefaultMunch]:
-        """获取 _id 列表"""
-        if skip > 10000 or limit > 10000:
-            raise AsMongoError("skip 和 limit 不能大于 10000")
+        return await self.connect(db.list_collection_names(
+            filter={"type": "collection", "name": {"$not": re.compile(r"^system\.")}},
+            nameOnly=True, authorizedCollections=True))
+
+    def get_id_paginator(self, collection: str, db_name: str = None, *,
+                         key: str = "_id", offset: TypeMongoId | tuple = None,
+                         filter_doc: dict = None, hint: str | dict = None,
+                         page_size: int = 50, mixed_types: bool = True) -> KeysetPaginator:
+        """keyset 分页获取 _id（key 不是 _id 时同时返回 key），后台预取下一页
+
+        配置了 check_target_latency 时按每页的耗时自动调整 page_size，最大为 check_max_batch_size
+        mixed_types 分页的值是否有多种 BSON 类型，为 False 时不添加跨类型的查询条件
+        """
         db = self.client.get_database(db_name) if db_name else self.db
         coll = db.get_collection(collection)
-        if id_offset:
-            # as_cursor = db.user.find({}, {"_id": 1}, max_time_ms=5000).sort({"_id": 1}).skip(skip).limit(limit)
-            as_cursor = coll.find({"_id": {"$gt": id_offset}}, {"_id": 1}).sort(
-                [("_id", 1)]).skip(skip).limit(limit).max_time_ms(5000)
-        else:
-            as_cursor = coll.find({}, {"_id": 1}).sort(
-                [("_id", 1)]).skip(skip).limit(limit).max_time_ms(5000)
-        async for data in as_cursor:
-            yield DefaultMunch(**data)
-            # 返回数据： {'_id': "2894359138941981"}
-
-    async def get_last_id(self, collection: str, db_name: str = None) -> TypeMongoId:
-        """获取最后的 _id"""
+        projection = {"_id": 1} if key == "_id" else {key: 1, "_id": 1}
+        return KeysetPaginator(coll, filter_doc, projection, key=key, offset=offset,
+                               hint=hint, page_size=page_size,
+                               max_page_size=max(settings.check_max_batch_size, page_size),
+                               target_latency=settings.check_target_latency or None,
+                               mixed_types=mixed_types,
+                               on_fetch=functools.partial(self.on_id_page_fetch, f"{db_name}.{collection}"))
+
+    def on_id_page_fetch(self, ns: str, page: list[dict], elapsed: float):
+        metrics.query_latency.observe(elapsed, side=self.name, method="get_id_page")
+        profiling.add(ns, "list_ids", elapsed)
+
+    async def find_edge_id(self, collection: str, db_name: str = None, *, direction: int,
+                           filter_doc: dict = None, hint: str | dict = None) -> TypeMongoId:
+        """按 _id 排序获取第一个（direction=1）或最后一个（direction=-1）_id，没有数据时返回 None"""
         db = self.client.get_database(db_name) if db_name else self.db
         coll = db.get_collection(collection)
 
@@ -53,33 +83,169 @@ class MongoOp(AsMongo):
         #     d = DefaultMunch(**data)
         #     return d.get("_id")
 
+        kwargs = dict(hint=hint) if hint else {}
+        if not filter_doc and not hint:
+            # 只使用 _id 索引，很快返回
+            kwargs["max_time_ms"] = 5000
+        # 有 filter_doc/hint 时不限制服务端耗时（仍受客户端 timeoutMS 限制），
+        # 需要有 {等值字段..., _id: 1} 的索引，否则按 _id 排序是内存排序
         data = await self.connect(
-            coll.find_one({}, {"_id": 1}, sort=[("_id", -1)], max_time_ms=5000)
+            coll.find_one(filter_doc or {}, {"_id": 1}, sort=[("_id", direction)], **kwargs)
         )
-        return data.get("_id")
+        return data.get("_id") if data else None
+
+    @timed
+    async def get_first_id(self, collection: str, db_name: str = None, *,
+                           filter_doc: dict = None, hint: str | dict = None) -> TypeMongoId:
+        """获取第一个 _id，没有数据时返回 None"""
+        return await self.find_edge_id(collection, db_name, direction=1, filter_doc=filter_doc, hint=hint)
 
-    async def count_id(self, collection: str, db_name: str = None) -> int:
-        """获取数据数量"""
+    @timed
+    async def get_last_id(self, collection: str, db_name: str = None, *,
+                          filter_doc: dict = None, hint: str | dict = None) -> TypeMongoId:
+        """获取最后的 _id，没有数据时返回 None"""
+        return await self.find_edge_id(collection, db_name, direction=-1, filter_doc=filter_doc, hint=hint)
+
+    @timed
+    async def count_id(self, collection: str, db_name: str = None, *, filter_doc: dict = None) -> int:
+        """获取数据数量，没有 filter_doc 时为估算值"""
         db = self.client.get_database(db_name) if db_name else self.db
         coll = db.get_collection(collection)
-        count = await self.connect(
-            # coll.count_documents({}, hint="_id")
-            coll.estimated_document_count(maxTimeMS=9000)  # 这个才是db.collection.count() 命令
-        )
+        if filter_doc:
+            count = await self.connect(coll.count_documents(filter_doc))
+        else:
+            count = await self.connect(
+                # coll.count_documents({}, hint="_id")
+                coll.estimated_document_count(maxTimeMS=9000)  # 这个才是db.collection.count() 命令
+            )
         logger.debug(f"Mongo {db_name}.{collection} count {count}")
         return count
 
-    async def find_id_info(self, doc_id: TypeMongoId, collection: str, db_name: str = None) -> dict:
-        """更新UP主信息"""
+    @timed
+    async def find_id_info(self, doc_id: TypeMongoId, collection: str, db_name: str = None, *,
+                           filter_doc: dict = None) -> dict:
+        """获取 _id 对应的文档，filter_doc 不匹配时返回 None"""
+        db = self.client.get_database(db_name) if db_name else self.db
+        coll = db.get_collection(collection)
+        data = await coll.find_one(and_filter({"_id": doc_id}, filter_doc))
+        self.record_bytes_read([data], collection, db_name)
+        return data
+
+    @timed
+    async def find_by_ids(self, doc_ids: list[TypeMongoId], collection: str,
+                          db_name: str = None) -> dict[tuple, DefaultMunch]:
+        """批量获取文档，返回 {bson_hash_key(_id): 文档}，不存在的 _id 不会返回
+
+        使用 bson_hash_key 区分 python 中相等的 1 和 True 等不同的 _id
+        """
         db = self.client.get_database(db_name) if db_name else self.db
         coll = db.get_collection(collection)
-        return await coll.find_one({"_id": doc_id})
+        as_cursor = coll.find({"_id": {"$in": doc_ids}})
+        datas = {bson_hash_key(data["_id"]): data async for data in as_cursor}
+        self.record_bytes_read(list(datas.values()), collection, db_name)
+        return datas
+
+    @timed
+    async def bulk_write(self, requests: list, collection: str, db_name: str = None) -> BulkWriteResult:
+        """无序批量写入，单条失败不影响其他写入"""
+        db = self.client.get_database(db_name) if db_name else self.db
+        coll = db.get_collection(collection)
+        return await self.connect(coll.bulk_write(requests, ordered=False))
+
+    async def is_mongos(self) -> bool:
+        """判断连接的是否为分片集群的 mongos"""
+        try:
+            result = await self.connect(self.client.admin.command("hello"))
+        except AsMongoError:
+            # 4.4.2 / 4.2.10 以前的版本没有 hello 命令
+            result = await self.connect(self.client.admin.command("isMaster"))
+        return result.get("msg") == "isdbgrid"
+
+    async def get_shard_hosts(self) -> dict[str, str]:
+        """从 config.shards 获取分片信息，返回 {分片名: host}
+
+        host 格式如: rs0/192.168.1.1:27018,192.168.1.2:27018
+        """
+        as_cursor = self.client.config.shards.find({}, {"_id": 1, "host": 1})
+        return {data["_id"]: data["host"] async for data in as_cursor}
+
+    async def get_shard_key(self, collection: str, db_name: str) -> dict | None:
+        """获取集合的分片键，未分片的集合返回 None"""
+        data = await self.connect(
+            self.client.config.collections.find_one(
+                {"_id": f"{db_name}.{collection}", "dropped": {"$ne": True}})
+        )
+        if not data:
+            return None
+        return dict(data.get("key") or {}) or None
+
+    async def get_chunk_ranges(self, collection: str, db_name: str) -> list[tuple[TypeMongoId, TypeMongoId, str]]:
+        """从 config.chunks 获取按 _id 分片的集合的 chunk 范围
+
+        返回按 min 排序的 [(min_id, max_id, shard), ...]，区间为 [min_id, max_id)，
+        边界可能为 MinKey/MaxKey。
+        """
+        ns = f"{db_name}.{collection}"
+        coll_meta = await self.connect(self.client.config.collections.find_one({"_id": ns}))
+        if not coll_meta:
+            return []
+        # mongodb 5.0 以后 config.chunks 使用 uuid 关联集合，4.4 及以前只有 ns
+        chunk_filter = {"$or": [{"uuid": coll_meta["uuid"]}, {"ns": ns}]} if coll_meta.get("uuid") else {"ns": ns}
+        as_cursor = self.client.config.chunks.find(
+            chunk_filter, {"min": 1, "max": 1, "shard": 1}).sort([("min", 1)])
+        return [(data["min"]["_id"], data["max"]["_id"], data["shard"]) async for data in as_cursor]
+
+    async def is_balancer_running(self) -> bool:
+        """判断分片集群的 balancer 是否开启"""
+        result = await self.connect(self.client.admin.command("balancerStatus"))
+        return result.get("mode") != "off"
+
+
+def and_filter(*filter_docs: dict | None) -> dict:
+    """合并多个查询条件，忽略空条件"""
+    filter_docs = [f for f in filter_docs if f]
+    if len(filter_docs) > 1:
+        return {"$and": filter_docs}
+    return filter_docs[0] if filter_docs else {}
+
+
+def get_shard_uri(uri: str, shard_host: str) -> str:
+    """使用 mongos 的 uri（认证信息和参数）生成直连分片副本集的 uri
+
+    shard_host 为 config.shards 中的 host，如: rs0/h1:27018,h2:27018
+    """
+    scheme, rest = uri.split("://", 1)
+    netloc, _, path_query = rest.partition("/")
+    path, _, query = path_query.partition("?")
+    userinfo = netloc.rsplit("@", 1)[0] + "@" if "@" in netloc else ""
+    replica_set, _, hosts = shard_host.rpartition("/")
+    params = [(k, v) for k, v in parse_qsl(query) if k not in ("replicaSet", "directConnection")]
+    if scheme == "mongodb+srv" and not any(k in ("tls", "ssl") for k, _ in params):
+        # srv 默认开启 tls，直连分片时需要保持一致
+        params.append(("tls", "true"))
+    if replica_set:
+        params.append(("replicaSet", replica_set))
+    query = urlencode(params)
+    return f"mongodb://{userinfo}{hosts}/{path}{'?' + query if query else ''}"
+
+
+_shard_ops: dict[str, MongoOp] = {}
+
+
+def get_shard_op(shard_name: str, shard_host: str) -> MongoOp:
+    """获取直连源分片的 MongoOp，同一个分片复用同一个客户端"""
+    if shard_name not in _shard_ops:
+        _shard_ops[shard_name] = MongoOp(get_shard_uri(settings.mongo_src_uri, shard_host),
+                                         name=f"src:{shard_name}")
+    return _shard_ops[shard_name]
 
 
-mongo_src = MongoOp(settings.mongo_src_uri)
-mongo_dst = MongoOp(settings.mongo_dst_uri)
+mongo_src = MongoOp(settings.mongo_src_uri, name="src")
+mongo_dst = MongoOp(settings.mongo_dst_uri, name="dst")
 
 __all__ = [
+    "MongoOp",
     "mongo_src",
-    "mongo_dst"
+    "mongo_dst",
+    "get_shard_op",
 ]
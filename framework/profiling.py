@@ -0,0 +1,126 @@
+"""
+检查过程的分阶段耗时统计和性能分析
+
+stage 统计每个集合各阶段（获取 _id 列表、获取源数据、获取目标数据、对比、DeepDiff、写结果文件）
+的次数、墙钟时间和 CPU 时间，结束时输出耗时分布报告。
+  获取数据的阶段包含了 bson 解码的时间（在 motor 的线程中解码）。
+  await 的阶段只统计墙钟时间，并发任务的耗时会累加，所以总和可能大于实际运行时间。
+
+profile_window 在一段时间内开启 cProfile，同时采样所有 asyncio 任务的协程调用栈，
+协程调用栈按 flamegraph 的 collapsed 格式输出，可以看到时间都在 await 哪里。
+"""
+import time
+import asyncio
+import cProfile
+import pstats
+import io
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Callable
+from loguru import logger
+
+
+__all__ = ["enabled", "enable", "stage", "add", "timed_call", "report", "profile_window"]
+
+enabled: bool = False
+
+# {(ns, stage): [次数, 墙钟时间, CPU时间]}，没有统计 CPU 时间的阶段 CPU时间为 None
+_stats: dict[tuple[str, str], list[float | None]] = {}
+
+_null = nullcontext()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def add(ns: str, name: str, wall: float, cpu: float = None):
+    """记录一次阶段耗时，cpu 为 None 时表示没有统计 CPU 时间"""
+    if not enabled:
+        return
+    data = _stats.setdefault((ns, name), [0, 0.0, None])
+    data[0] += 1
+    data[1] += wall
+    if cpu is not None:
+        data[2] = (data[2] or 0.0) + cpu
+
+
+@contextmanager
+def _stage(ns: str, name: str, cpu: bool):
+    start, cpu_start = time.perf_counter(), time.thread_time() if cpu else 0.0
+    try:
+        yield
+    finally:
+        add(ns, name, time.perf_counter() - start, time.thread_time() - cpu_start if cpu else None)
+
+
+def stage(ns: str, name: str, cpu: bool = False):
+    """统计一个阶段的耗时，cpu=True 时同时统计当前线程的 CPU 时间（中间不能有 await）"""
+    if not enabled:
+        return _null
+    return _stage(ns, name, cpu)
+
+
+def timed_call(ns: str, name: str, func: Callable, *args, **kwargs):
+    """调用函数并统计墙钟和 CPU 时间，可以放在 asyncio.to_thread 中执行"""
+    with stage(ns, name, cpu=True):
+        return func(*args, **kwargs)
+
+
+def report() -> str:
+    """按集合输出各阶段的耗时分布"""
+    lines = []
+    for ns in sorted({ns for ns, _ in _stats}):
+        stats = {name: data for (n, name), data in _stats.items() if n == ns}
+        total_wall = sum(data[1] for data in stats.values()) or 1
+        lines.append(f"{ns}:")
+        lines.append(f"  {'stage':<12}{'count':>10}{'wall(s)':>12}{'avg(ms)':>10}{'cpu(s)':>10}{'wall%':>8}")
+        for name, (count, wall, cpu) in sorted(stats.items(), key=lambda x: -x[1][1]):
+            # 没有统计 CPU 时间的阶段（await 的阶段）显示 -，不是没有使用 CPU
+            cpu_s = f"{cpu:.3f}" if cpu is not None else "-"
+            lines.append(f"  {name:<12}{count:>10}{wall:>12.3f}{wall / count * 1000:>10.3f}"
+                         f"{cpu_s:>10}{wall / total_wall * 100:>7.1f}%")
+    return "\n".join(lines)
+
+
+def _task_stack(task: asyncio.Task, limit: int) -> str:
+    """获取任务的协程调用栈，从外到内用 ; 连接"""
+    frames = [f"{f.f_code.co_name} ({Path(f.f_code.co_filename).name}:{f.f_lineno})"
+              for f in task.get_stack(limit=limit)]
+    return ";".join([task.get_name(), *frames])
+
+
+async def profile_window(seconds: float, out_path: Path, *, delay: float = 0,
+                         interval: float = 0.01, stack_limit: int = 30):
+    """在 seconds 时间内开启 cProfile 并采样 asyncio 任务的调用栈
+
+    输出:
+      {out_path}.prof         cProfile 结果，可以用 snakeviz 等工具查看
+      {out_path}.txt          cProfile 按累计时间排序的前 50 项
+      {out_path}.stacks.txt   协程调用栈采样（collapsed 格式，可以用 flamegraph.pl 生成火焰图）
+    """
+    await asyncio.sleep(delay)
+    logger.info(f"开始性能分析 {seconds} 秒 ...")
+    samples: Counter[str] = Counter()
+    current = asyncio.current_task()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            for task in asyncio.all_tasks():
+                if task is not current:
+                    samples[_task_stack(task, stack_limit)] += 1
+            await asyncio.sleep(interval)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(f"{out_path}.prof")
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(50)
+        # 任务被取消时 finally 中不能再 await，同步写入结果文件
+        Path(f"{out_path}.txt").write_text(stream.getvalue())
+        Path(f"{out_path}.stacks.txt").write_text(
+            "".join(f"{stack} {count}\n" for stack, count in samples.most_common()))
+        logger.info(f"性能分析结果写入 {out_path}.*")
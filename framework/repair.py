@@ -0,0 +1,131 @@
+"""
+修复检查失败的数据
+
+从 *.check.failure.txt 读取检查失败的 _id，按批次从源库重新读取文档，
+使用 ordered=False 的 bulk_write 写入目标库：
+  源库存在的文档 replace（upsert），源库已不存在的文档 delete。
+每个批次写入后重新校验，仍不一致的 _id 写入 *.repair.failure.txt。
+"""
+import time
+import asyncio
+from typing import Final
+from pathlib import Path
+import aiofiles
+from loguru import logger
+from pymongo import ReplaceOne, DeleteOne
+
+from commutils.asmongo import AsMongoError, TypeMongoId, bson_hash_key
+from .mongoclient import mongo_src
+from .mongoclient import mongo_dst
+from .checkcoll import DataCheck, format_result_id, parse_result_id
+
+
+__all__ = ["DataRepair"]
+
+
+class DataRepair:
+    batch_size: int = 500
+    # 每秒最多修复的文档数，0 为不限制
+    rate_limit: int = 0
+
+    result_path: Path = DataCheck.result_path
+
+    def __init__(self, *, db_name: str, collection: str,
+                 batch_size: int = None, rate_limit: int = None,
+                 ):
+        self.db_name: Final[str] = db_name
+        self.collection: Final[str] = collection
+        self.batch_size = batch_size or self.batch_size
+        self.rate_limit = rate_limit if rate_limit is not None else self.rate_limit
+
+        self.repair_failure_file: Final[str] = \
+            f'{self.result_path.as_posix()}/{db_name}.{collection}.repair.failure.txt'
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.db_name}.{self.collection}>"
+
+    @classmethod
+    def get_failure_colls(cls) -> list[tuple[str, str]]:
+        """从 result 目录的检查失败文件获取需要修复的 (db_name, collection)"""
+        colls: dict[tuple[str, str], None] = {}
+        for file in cls.result_path.glob("*.check.failure.txt"):
+            # {db}.{collection}.check.failure.txt 或 {db}.{collection}.{shard}.check.failure.txt
+            name_l = file.name.removesuffix(".check.failure.txt").split(".")
+            if len(name_l) >= 2:
+                colls[(name_l[0], name_l[1])] = None
+        return sorted(colls)
+
+    def get_failure_files(self) -> list[Path]:
+        """获取集合的检查失败文件（包括分片检查的 *.{shard}.check.failure.txt）"""
+        files = [self.result_path / f"{self.db_name}.{self.collection}.check.failure.txt"]
+        files.extend(self.result_path.glob(f"{self.db_name}.{self.collection}.*.check.failure.txt"))
+        return [f for f in files if f.is_file()]
+
+    async def read_failure_ids(self) -> tuple[list[TypeMongoId], list[str]]:
+        """从检查失败文件读取需要修复的 _id（去重，保持顺序）
+
+        返回 (_id 列表, 无法解析的行)，无法解析的行计入修复失败。
+        """
+        # 按 bson_hash_key 去重，python 中相等的 1 和 True 是不同的 _id
+        failure_ids: dict[tuple, TypeMongoId] = {}
+        bad_lines: list[str] = []
+        for file in self.get_failure_files():
+            async with aiofiles.open(file, mode='r') as f:
+                async for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        doc_id = parse_result_id(line)
+                    except ValueError:
+                        logger.warning(f"{file} 内容错误: {line.rstrip()}")
+                        bad_lines.append(line.rstrip('\n'))
+                    else:
+                        failure_ids.setdefault(bson_hash_key(doc_id), doc_id)
+        return list(failure_ids.values()), bad_lines
+
+    async def repair_batch(self, doc_ids: list[TypeMongoId]) -> list[TypeMongoId]:
+        """修复一批数据，返回修复后仍不一致的 _id"""
+        src_docs = await mongo_src.find_by_ids(doc_ids, self.collection, self.db_name)
+        requests = [ReplaceOne({"_id": doc_id}, src_docs[bson_hash_key(doc_id)], upsert=True)
+                    if bson_hash_key(doc_id) in src_docs else DeleteOne({"_id": doc_id})
+                    for doc_id in doc_ids]
+        try:
+            await mongo_dst.bulk_write(requests, self.collection, self.db_name)
+        except AsMongoError as e:
+            # ordered=False 时其他写入已执行，失败的数据在重新校验时记录
+            logger.error(f"{self} 批量写入错误: {e}")
+
+        src_docs, dst_docs = await asyncio.gather(
+            mongo_src.find_by_ids(doc_ids, self.collection, self.db_name),
+            mongo_dst.find_by_ids(doc_ids, self.collection, self.db_name),
+        )
+        return [doc_id for doc_id in doc_ids
+                if src_docs.get(bson_hash_key(doc_id)) != dst_docs.get(bson_hash_key(doc_id))]
+
+    async def start(self):
+        if not self.get_failure_files():
+            logger.info(f"{self} 没有检查失败文件，跳过修复。")
+            return
+        self.result_path.mkdir(exist_ok=True)
+        failure_ids, bad_lines = await self.read_failure_ids()
+        logger.info(f"启动修复 {self}，共 {len(failure_ids)} 条数据 ...")
+        repaired = 0
+        async with aiofiles.open(self.repair_failure_file, mode='w') as rff:
+            for line in bad_lines:
+                # 无法解析 _id 的行原样记录，需要手动处理
+                await rff.write(f"{line}\n")
+            for i in range(0, len(failure_ids), self.batch_size):
+                batch_start = time.monotonic()
+                doc_ids = failure_ids[i:i + self.batch_size]
+                still_failure_ids = await self.repair_batch(doc_ids)
+                repaired += len(doc_ids) - len(still_failure_ids)
+                for doc_id in still_failure_ids:
+                    await rff.write(f"{format_result_id(doc_id)}\n")
+                await rff.flush()
+                logger.info(f"修复 {self} {i + len(doc_ids)}/{len(failure_ids)} 条，"
+                            f"本批次仍不一致 {len(still_failure_ids)} 条。")
+                if self.rate_limit:
+                    # 按每秒文档数限速
+                    await asyncio.sleep(len(doc_ids) / self.rate_limit - (time.monotonic() - batch_start))
+        logger.info(f"修复 {self} 完成，成功 {repaired} 条，"
+                    f"失败 {len(failure_ids) - repaired + len(bad_lines)} 条。")
@@ -0,0 +1,91 @@
+"""
+分片集群的检查
+
+通过 mongos 按 _id 排序查询分片集合时，只要 _id 不是分片键，就会在 mongos 上做 scatter-gather 合并。
+这里从 config.chunks/config.shards 读取 chunk 范围，按分片规划检查任务，
+每个分片只检查自己拥有的 chunk 范围，并且直接从分片的副本集读取源数据，
+检查速度随分片数量线性增长。
+
+只有分片键为 {_id: 1}（范围分片）时，chunk 范围才是 _id 的范围，才能安全地直连分片读取：
+  只读取分片拥有的 chunk 范围，孤儿文档（orphan）不会被重复检查。
+其他情况退回到通过 mongos 检查。
+"""
+import asyncio
+from typing import Final
+from loguru import logger
+
+from commutils.asmongo import TypeMongoId
+from .mongoclient import mongo_src
+from .mongoclient import get_shard_op
+from .checkcoll import DataCheck
+
+
+__all__ = ["ShardDataCheck", "get_shard_plan"]
+
+
+def get_shard_plan(chunk_ranges: list[tuple[TypeMongoId, TypeMongoId, str]]
+                   ) -> dict[str, list[tuple[TypeMongoId, TypeMongoId]]]:
+    """把按 min 排序的 chunk 范围按分片分组，并合并同一分片上相邻的 chunk
+
+    返回 {分片名: [(min_id, max_id), ...]}
+    """
+    plan: dict[str, list[tuple[TypeMongoId, TypeMongoId]]] = {}
+    for id_min, id_max, shard in chunk_ranges:
+        ranges = plan.setdefault(shard, [])
+        if ranges and ranges[-1][1] == id_min:
+            ranges[-1] = (ranges[-1][0], id_max)
+        else:
+            ranges.append((id_min, id_max))
+    return plan
+
+
+class ShardDataCheck:
+    """分片集合的检查，每个分片一个 DataCheck 并发检查"""
+
+    def __init__(self, *, db_name: str, collection: str,
+                 concurrent: int = None, direct_read: bool = True,
+                 filter_doc: dict = None, hint: str | dict = None,
+                 ):
+        """
+        direct_read  是否直连分片副本集读取源数据，否则仍通过 mongos 读取（只按 chunk 范围规划）
+        filter_doc   只检查符合条件的数据
+        hint         获取 _id 列表时使用的索引
+        """
+        self.db_name: Final[str] = db_name
+        self.collection: Final[str] = collection
+        self.concurrent = concurrent
+        self.direct_read: Final[bool] = direct_read
+        self.filter_doc: Final[dict] = filter_doc
+        self.hint: Final[str | dict] = hint
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.db_name}.{self.collection}>"
+
+    async def get_checks(self) -> list[DataCheck]:
+        """按分片规划检查任务"""
+        mongos_checks = [DataCheck(db_name=self.db_name, collection=self.collection,
+                                   concurrent=self.concurrent,
+                                   filter_doc=self.filter_doc, hint=self.hint)]
+        shard_key = await mongo_src.get_shard_key(self.collection, self.db_name)
+        if shard_key != {"_id": 1}:
+            if shard_key:
+                logger.warning(f"{self} 分片键为 {shard_key}，不是 _id 范围分片，通过 mongos 检查。")
+            return mongos_checks
+
+        chunk_ranges = await mongo_src.get_chunk_ranges(self.collection, self.db_name)
+        plan = get_shard_plan(chunk_ranges)
+        if not plan:
+            logger.warning(f"{self} 没有获取到 chunk 信息，通过 mongos 检查。")
+            return mongos_checks
+        shard_hosts = await mongo_src.get_shard_hosts() if self.direct_read else {}
+        logger.info(f"{self} 共 {len(chunk_ranges)} 个 chunk，分布在 {len(plan)} 个分片。")
+        return [DataCheck(db_name=self.db_name, collection=self.collection,
+                          concurrent=self.concurrent,
+                          src=get_shard_op(shard, shard_hosts[shard]) if self.direct_read else None,
+                          id_ranges=id_ranges, tag=shard,
+                          filter_doc=self.filter_doc, hint=self.hint)
+                for shard, id_ranges in plan.items()]
+
+    async def start(self):
+        checks = await self.get_checks()
+        await asyncio.gather(*[check.start() for check in checks])
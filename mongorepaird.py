@@ -0,0 +1,3 @@
+from framework import run_repair
+
+run_repair()
@@ -0,0 +1,9 @@
+import os
+
+
+# test_mongo.py 和 test_aiofiles.py 是连接测试环境手动运行的脚本，不由 pytest 收集
+collect_ignore = ["test_mongo.py", "test_aiofiles.py"]
+
+# framework 导入时需要 mongo 的 uri（只创建客户端，不会连接）
+os.environ.setdefault("MONGO_SRC_URI", "mongodb://127.0.0.1:27017/test")
+os.environ.setdefault("MONGO_DST_URI", "mongodb://127.0.0.1:27017/test")
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from bson.objectid import ObjectId
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
+from munch import DefaultMunch
+from mongomock_motor import AsyncMongoMockClient
+
+from commutils.asmongo import AsMongoError
+
+from framework.mongoclient import mongo_src, mongo_dst
+from framework.checkcoll import DataCheck, format_result_id, parse_result_id
+
+
+@pytest.fixture
+def mock_mongo(tmp_path, monkeypatch):
+    """把 mongo_src/mongo_dst 替换为 mongomock-motor，结果文件写入临时目录"""
+    monkeypatch.setattr(DataCheck, "result_path", tmp_path)
+    clients = []
+    for mongo in (mongo_src, mongo_dst):
+        client = AsyncMongoMockClient(document_class=DefaultMunch)
+        monkeypatch.setattr(mongo, "_AsMongo__client", client)
+        clients.append(client)
+    return clients
+
+
+def insert(client, docs: list[dict]):
+    asyncio.run(client["db"]["c"].insert_many(docs))
+
+
+def read_result_ids(path) -> list[str]:
+    return [line.split("\t")[0] for line in path.read_text().splitlines()]
+
+
+@pytest.mark.parametrize("id_ranges, expect", [
+    # chunk 边界的类型和 _id 不同
+    ([(5, "zzz")], 10),
+    ([(0, "id-05"), ("id-05", "zzz")], 10),
+    ([("id-03", "id-07")], 4),
+])
+def test_check_id_ranges_bound_types(mock_mongo, tmp_path, id_ranges, expect):
+    docs = [{"_id": f"id-{i:02d}", "v": i} for i in range(10)]
+    insert(mock_mongo[0], docs)
+    insert(mock_mongo[1], docs)
+
+    check = DataCheck(db_name="db", collection="c", concurrent=3, id_ranges=id_ranges)
+    asyncio.run(check.start())
+    assert check.mixed_id_types is False
+    assert len(read_result_ids(tmp_path / "db.c.check.success.txt")) == expect
+
+
+def test_check_mixed_id_types(mock_mongo, tmp_path):
+    docs = [{"_id": x, "v": 1} for x in [1, 2.5, "a", "b"]]
+    insert(mock_mongo[0], docs)
+    insert(mock_mongo[1], docs[:3])
+
+    check = DataCheck(db_name="db", collection="c", concurrent=2)
+    asyncio.run(check.start())
+    assert check.mixed_id_types is True
+    assert len(read_result_ids(tmp_path / "db.c.check.success.txt")) == 3
+    assert read_result_ids(tmp_path / "db.c.check.failure.txt") == ['"b"']
+
+
+@pytest.mark.parametrize("data_id", [
+    "a b", "x\ty", "line\nbreak", "", 12, 1.5, True, False, ObjectId("64b000000000000000000000"),
+])
+def test_result_id_round_trip(data_id):
+    line = f"{format_result_id(data_id)}\t{{'values_changed': 'a b'}}\n"
+    result = parse_result_id(line)
+    assert result == data_id
+    assert type(result) is type(data_id)
+
+
+@pytest.mark.parametrize("line, data_id", [
+    ("12 int {'values_changed': {}}\n", 12),
+    ("64b000000000000000000000 ObjectId\n", ObjectId("64b000000000000000000000")),
+    ("abc str {x}", "abc"),
+])
+def test_parse_result_id_legacy(line, data_id):
+    assert parse_result_id(line) == data_id
+
+
+@pytest.mark.parametrize("line", ["abc", "12 unknown {x}"])
+def test_parse_result_id_error(line):
+    with pytest.raises(ValueError):
+        parse_result_id(line)
+
+
+@pytest.mark.parametrize("filter_doc, hint", [({"v": {"$gte": 0}}, None), (None, "v_1")])
+def test_get_id_edges_error_fallback(mock_mongo, monkeypatch, filter_doc, hint):
+    async def get_first_id(*args, **kwargs):
+        raise AsMongoError("operation exceeded time limit")
+
+    monkeypatch.setattr(mongo_src, "get_first_id", get_first_id)
+    check = DataCheck(db_name="db", collection="c", filter_doc=filter_doc, hint=hint)
+    # 配置了 filter_doc 或 hint 时不限制检查范围
+    assert asyncio.run(check.get_id_edges()) == (MinKey(), MaxKey())
+    assert check.mixed_id_types is True
+
+
+def test_check_id_edges_error_without_filter(mock_mongo, monkeypatch):
+    async def get_first_id(*args, **kwargs):
+        raise AsMongoError("not authorized")
+
+    monkeypatch.setattr(mongo_src, "get_first_id", get_first_id)
+    with pytest.raises(AsMongoError):
+        asyncio.run(DataCheck(db_name="db", collection="c").start())
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from framework.metrics import CollProgress, start_server
+
+
+def test_coll_progress_resumed():
+    progress = CollProgress("test.resumed")
+    progress.total, progress.resumed = 100, 40
+    progress.start_time -= 10
+    progress.update(30, 70)
+    assert progress.ratio == 0.7
+    # 只按本次检查的速度（3 条/秒）计算剩余的 30 条
+    assert round(progress.eta) == 10
+    assert progress.snapshot()["resumed"] == 40
+
+
+def test_coll_progress_without_total():
+    progress = CollProgress("test.no_total")
+    progress.update(10)
+    assert progress.ratio == 0.0
+    assert progress.eta is None
+
+
+def test_start_server_bind_error():
+    async def run():
+        server = await start_server("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            # 端口被占用时启动就报错
+            with pytest.raises(OSError):
+                await start_server("127.0.0.1", port)
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /metrics HTTP/1.1\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            return response
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    assert b"mongocheckd_docs_checked_total" in asyncio.run(run())
@@ -0,0 +1,128 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from bson.objectid import ObjectId
+from bson.decimal128 import Decimal128
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
+from mongomock_motor import AsyncMongoMockClient
+
+from commutils.asmongo import KeysetPaginator, range_filter, bson_sort_key, bson_hash_key
+
+
+def test_range_filter_mixed_types():
+    assert range_filter("_id", "$gt", "b") == {"$or": [
+        {"_id": {"$gt": "b"}},
+        {"_id": {"$type": "object"}}, {"_id": {"$type": "array"}}, {"_id": {"$type": "binData"}},
+        {"_id": {"$type": "objectId"}}, {"_id": {"$type": "bool"}}, {"_id": {"$type": "date"}},
+    ]}
+    assert range_filter("_id", "$lt", 5) == {"$or": [{"_id": {"$lt": 5}}, {"_id": None}]}
+
+
+def test_range_filter_single_type():
+    assert range_filter("_id", "$gt", 5, mixed_types=False) == {"_id": {"$gt": 5}}
+    # 排序在最后的类型没有需要额外匹配的类型
+    assert range_filter("_id", "$gte", datetime(2023, 1, 1)) == {"_id": {"$gte": datetime(2023, 1, 1)}}
+    # MinKey/MaxKey 本身可以和所有类型比较
+    assert range_filter("_id", "$lt", MaxKey()) == {"_id": {"$lt": MaxKey()}}
+
+
+def test_bson_sort_key():
+    oid = ObjectId("64b000000000000000000000")
+    values = [oid, "a", Decimal128("2.5"), MaxKey(), 3, True, 1.5, MinKey(), None, float("nan")]
+    assert sorted(values, key=bson_sort_key) == [
+        values[7], None, values[9], 1.5, Decimal128("2.5"), 3, "a", oid, True, values[3]]
+
+
+def test_bson_sort_key_unsupported():
+    with pytest.raises(ValueError):
+        bson_sort_key(object())
+
+
+def test_bson_hash_key():
+    # python 中 1 == 1.0 == True，BSON 中 true 是不同的值
+    assert len({bson_hash_key(x) for x in [1, 1.0, Decimal128("1"), True]}) == 2
+    assert bson_hash_key({"a": 1}) == bson_hash_key({"a": 1})
+    assert bson_hash_key([1]) != bson_hash_key("[1]")
+
+
+def get_coll(docs: list[dict]):
+    coll = AsyncMongoMockClient()["test"]["paginate"]
+    if docs:
+        asyncio.run(coll.insert_many(docs))
+    return coll
+
+
+@pytest.mark.parametrize("prefetch", [True, False])
+def test_keyset_paginator_pages(prefetch: bool):
+    coll = get_coll([{"_id": i, "v": i % 3} for i in range(10)])
+    fetched = []
+
+    async def run():
+        paginator = KeysetPaginator(coll, {}, {"_id": 1}, page_size=4, prefetch=prefetch,
+                                    mixed_types=False,
+                                    on_fetch=lambda page, elapsed: fetched.append(len(page)))
+        return [[d["_id"] for d in page] async for page in paginator.pages()], paginator.offset
+
+    pages, offset = asyncio.run(run())
+    assert pages == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert offset == 9
+    # 最后一页不足 page_size 时不再查询
+    assert fetched == [4, 4, 2]
+
+
+def test_keyset_paginator_last_page_full():
+    coll = get_coll([{"_id": i} for i in range(8)])
+    fetched = []
+
+    async def run():
+        paginator = KeysetPaginator(coll, page_size=4,
+                                    on_fetch=lambda page, elapsed: fetched.append(len(page)))
+        return [d["_id"] async for d in paginator]
+
+    assert asyncio.run(run()) == list(range(8))
+    # 最后一页刚好满页时，多查询一次空页结束
+    assert fetched == [4, 4, 0]
+
+
+def test_keyset_paginator_offset_and_filter():
+    coll = get_coll([{"_id": i, "v": i % 2} for i in range(10)])
+
+    async def run():
+        paginator = KeysetPaginator(coll, {"v": 0}, offset=3, page_size=2)
+        return [d["_id"] async for d in paginator]
+
+    assert asyncio.run(run()) == [4, 6, 8]
+
+
+def test_keyset_paginator_mixed_id_types():
+    oids = [ObjectId() for _ in range(3)]
+    coll = get_coll([{"_id": x} for x in [*oids, 1, 2, "a", "b"]])
+
+    async def run():
+        paginator = KeysetPaginator(coll, page_size=2)
+        return [d["_id"] async for d in paginator]
+
+    assert asyncio.run(run()) == [1, 2, "a", "b", *oids]
+
+
+def test_keyset_paginator_sort_key():
+    coll = get_coll([{"_id": i, "k": 10 - i // 2} for i in range(6)])
+
+    async def run():
+        paginator = KeysetPaginator(coll, key="k", page_size=4)
+        return [(d["k"], d["_id"]) async for d in paginator], paginator.offset
+
+    docs, offset = asyncio.run(run())
+    assert docs == [(8, 4), (8, 5), (9, 2), (9, 3), (10, 0), (10, 1)]
+    assert offset == (10, 1)
+
+
+def test_keyset_paginator_target_latency():
+    coll = get_coll([])
+    paginator = KeysetPaginator(coll, page_size=100, max_page_size=150, target_latency=0.1)
+    paginator.tune_page_size(0.01)
+    assert paginator.page_size == 150
+    paginator.tune_page_size(10)
+    assert paginator.page_size == 75
@@ -0,0 +1,34 @@
+import pytest
+
+from framework import profiling
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    monkeypatch.setattr(profiling, "enabled", True)
+    monkeypatch.setattr(profiling, "_stats", {})
+    return profiling._stats
+
+
+def test_report_cpu_not_measured(stats):
+    with profiling.stage("db.c", "src_fetch"):
+        pass
+    with profiling.stage("db.c", "compare", cpu=True):
+        sum(range(1000))
+    profiling.add("db.c", "list_ids", 0.5)
+    assert stats[("db.c", "src_fetch")][2] is None
+    assert stats[("db.c", "compare")][2] is not None
+
+    lines = {line.split()[0]: line.split() for line in profiling.report().splitlines()[2:]}
+    # 没有统计 CPU 时间的阶段显示 -
+    assert lines["list_ids"][4] == "-"
+    assert lines["src_fetch"][4] == "-"
+    assert lines["compare"][4] != "-"
+
+
+def test_stage_disabled(monkeypatch):
+    monkeypatch.setattr(profiling, "enabled", False)
+    monkeypatch.setattr(profiling, "_stats", {})
+    with profiling.stage("db.c", "write"):
+        pass
+    assert profiling._stats == {}
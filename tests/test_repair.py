@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from framework.checkcoll import format_result_id
+from framework.repair import DataRepair
+
+
+@pytest.fixture
+def result_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(DataRepair, "result_path", tmp_path)
+    return tmp_path
+
+
+def test_get_failure_colls(result_path):
+    for name in ["db1.c1.check.failure.txt", "db1.c1.rs0.check.failure.txt", "db1.c1.rs1.check.failure.txt",
+                 "db2.c2.check.failure.txt", "db1.c3.check.success.txt", "db1.c4.repair.failure.txt"]:
+        (result_path / name).write_text("")
+    assert DataRepair.get_failure_colls() == [("db1", "c1"), ("db2", "c2")]
+
+
+def test_get_failure_colls_without_result_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(DataRepair, "result_path", tmp_path / "result")
+    assert DataRepair.get_failure_colls() == []
+
+
+def test_read_failure_ids(result_path):
+    (result_path / "db.c.check.failure.txt").write_text(
+        "".join(f"{format_result_id(data_id)}\tdiff\n" for data_id in [1, True, "a b", 1]))
+    (result_path / "db.c.rs0.check.failure.txt").write_text("2 int {x}\n\nbad\n")
+    failure_ids, bad_lines = asyncio.run(DataRepair(db_name="db", collection="c").read_failure_ids())
+    # python 中 1 == True，但是是不同的 _id
+    assert [(type(x), x) for x in failure_ids] == [(int, 1), (bool, True), (str, "a b"), (int, 2)]
+    assert bad_lines == ["bad"]
+